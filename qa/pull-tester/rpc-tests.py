@@ -16,18 +16,53 @@ than:
       should run the tests.
     - `--coverage`: this generates a basic coverage report for the RPC
       interface.
+    - `-parallel=N`: run up to N tests at once (default 4), or with
+      `-parallel=auto`, as many as fit a budget of dogecoinds derived from
+      the number of cores and the available memory.
+    - `--shard=i/n`: run only the i-th (1 <= i <= n) of n shards of the
+      selected tests, and write the results to a JSON file
+      (`--resultsfile=<path>`, by default
+      `qa/rpc_test_results.shard<i>of<n>.json` in the build dir).  All
+      shards must see the same durations to agree on the split, so shards
+      are only balanced by duration with `--timingsfile=<path>`, a timings
+      file shared by all of them, and are otherwise dealt round-robin by
+      test name.  Shard runs don't record durations.  Neither do runs with
+      `--coverage` or `--profile`, as the instrumentation slows the tests
+      down.
+    - `--merge-results=<file>[,<file>...]`: print the summary table of
+      results files from several shards and record their durations (in
+      the `--timingsfile`, if given).  Fails if a shard of the split is
+      missing or given twice, or if a test appears in more than one file.
+    - `--profile`: profile each test's run_test with cProfile, keep the
+      profiles in a directory printed at the end, and report the Python
+      functions with the most own time across the suite.  Add
+      `--sampleinterval=<ms>` to also record sampled stacks, which are
+      merged into `all.folded` for flame graph tools.
+    - `-warmpool`: start the dogecoinds of the next queued test on the cached
+      chain while other tests run, for it to adopt instead of starting its
+      own, and report the test time this saved.
 
 For a description of arguments recognized by test scripts, see
 `qa/pull-tester/test_framework/test_framework.py:BitcoinTestFramework.main`.
 
 """
 
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import json
+import math
 import os
+import pstats
+import queue
+import threading
 import time
 import shutil
 import sys
 import subprocess
 import tempfile
+import traceback
 import re
 
 sys.path.append("qa/pull-tester/")
@@ -41,6 +76,16 @@ if os.name == 'posix':
 
 RPC_TESTS_DIR = SRCDIR + '/qa/rpc-tests/'
 
+# With -parallel=auto, tests are scheduled by the number of dogecoinds they
+# start, against a budget of NODES_PER_CPU nodes per core that also leaves
+# NODE_MEMORY_MB of available memory for each node
+NODES_PER_CPU = 2
+NODE_MEMORY_MB = 256
+
+# Durations of the last passing run of each test, used to schedule the
+# longest tests first
+TIMINGS_FILE = BUILDDIR + '/qa/cache/rpc_test_timings.json'
+
 #If imported values are not defined then set to zero (or disabled)
 if 'ENABLE_WALLET' not in vars():
     ENABLE_WALLET=0
@@ -52,15 +97,25 @@ if 'ENABLE_ZMQ' not in vars():
     ENABLE_ZMQ=0
 
 ENABLE_COVERAGE=0
+ENABLE_PROFILE=0
 
 #Create a set to store arguments and create the passon string
 opts = set()
 passon_args = []
 PASSON_REGEX = re.compile("^--")
 PARALLEL_REGEX = re.compile('^-parallel=')
+SHARD_REGEX = re.compile(r'^--shard=(\d+)/(\d+)$')
+RESULTS_SHARD_REGEX = re.compile(r'^(\d+)/(\d+)$')
+NUM_NODES_REGEX = re.compile(r'self\.num_nodes\s*=\s*(\d+)')
+CLEAN_CHAIN_REGEX = re.compile(r'self\.setup_clean_chain\s*=\s*True')
 
 print_help = False
 run_parallel = 4
+shard = None
+results_file = None
+timings_file = None
+use_warm_pool = False
+merge_files = None
 
 for arg in sys.argv[1:]:
     if arg == "--help" or arg == "-h" or arg == "-?":
@@ -68,10 +123,27 @@ for arg in sys.argv[1:]:
         break
     if arg == '--coverage':
         ENABLE_COVERAGE = 1
+    elif arg == '--profile':
+        ENABLE_PROFILE = 1
+    elif arg.startswith('--shard='):
+        match = SHARD_REGEX.match(arg)
+        shard = tuple(int(n) for n in match.groups()) if match else None
+        if not shard or not 1 <= shard[0] <= shard[1]:
+            print("Invalid shard %s, expected --shard=i/n with 1 <= i <= n" % arg)
+            sys.exit(1)
+    elif arg == '-warmpool':
+        use_warm_pool = True
+    elif arg.startswith('--resultsfile='):
+        results_file = arg.split(sep='=', maxsplit=1)[1]
+    elif arg.startswith('--timingsfile='):
+        timings_file = arg.split(sep='=', maxsplit=1)[1]
+    elif arg.startswith('--merge-results='):
+        merge_files = arg.split(sep='=', maxsplit=1)[1].split(',')
     elif PASSON_REGEX.match(arg):
         passon_args.append(arg)
     elif PARALLEL_REGEX.match(arg):
-        run_parallel = int(arg.split(sep='=', maxsplit=1)[1])
+        run_parallel = arg.split(sep='=', maxsplit=1)[1]
+        run_parallel = run_parallel if run_parallel == 'auto' else int(run_parallel)
     else:
         opts.add(arg)
 
@@ -101,6 +173,7 @@ if ENABLE_ZMQ:
 
 testScripts = [
     # longest test should go first, to favor running tests in parallel
+    # (only used for tests without a duration in TIMINGS_FILE)
     'wallet-hd.py',
     'walletbackup.py',
     # vv Tests less than 5m vv
@@ -208,6 +281,7 @@ testScriptsExt = [
     'getblocktemplate_proposals.py',
     'txn_doublespend.py',
     'txn_clone.py --mineblock',
+    'mempool_stress.py --via=p2p --count=1000',
     'forknotify.py',
     'invalidateblock.py',
     'maxblocksinflight.py',
@@ -229,6 +303,26 @@ def runtests():
         print(f"No tests selected; do you have a typo in {opts}?")
         sys.exit(1)
 
+    if run_parallel == 'auto':
+        # Budget in dogecoinds rather than in tests
+        test_costs = {t: test_num_nodes(t) for t in test_list}
+        budget = node_budget()
+        print("Running tests with a budget of %d nodes" % budget)
+    else:
+        test_costs = None
+        budget = run_parallel
+
+    timings = load_test_timings()
+    if shard:
+        shard_timings = load_test_timings(timings_file) if timings_file else None
+        test_list = shard_tests(test_list, shard_timings, shard[1])[shard[0] - 1]
+        print("Running shard %d/%d: %d tests" % (shard[0], shard[1], len(test_list)))
+        if not test_list:
+            write_results_file([], shard)
+            sys.exit(0)
+    test_list = schedule_tests(test_list, timings)
+    expected_makespan = estimate_makespan(test_list, timings, budget, test_costs)
+
     if print_help:
         # Only print help of the first script and exit
         subprocess.check_call((RPC_TESTS_DIR + test_list[0]).split() + ['-h'])
@@ -244,30 +338,48 @@ def runtests():
     if coverage:
         flags.append(coverage.flag)
 
-    if len(test_list) > 1 and run_parallel > 1:
+    if (len(test_list) > 1 and budget > 1) or use_warm_pool:
         # Populate cache
         subprocess.check_output([RPC_TESTS_DIR + 'create_cache.py'] + flags)
+    warm_pool = WarmPool("%s/qa/cache" % BUILDDIR) if use_warm_pool else None
+    profiledir = None
+    if ENABLE_PROFILE:
+        profiledir = tempfile.mkdtemp(prefix="profile")
+        flags += ["--profile", "--profiledir=%s" % profiledir]
 
     #Run Tests
-    max_len_name = len(max(test_list, key=len))
-    time_sum = 0
     time0 = time.time()
-    job_queue = RPCTestHandler(run_parallel, test_list, flags)
-    results = BOLD[1] + "%s | %s | %s\n\n" % ("TEST".ljust(max_len_name), "PASSED", "DURATION") + BOLD[0]
-    all_passed = True
-    for _ in range(len(test_list)):
+    num_tests = len(test_list)
+    job_queue = RPCTestHandler(budget, test_list, flags, test_costs, warm_pool, timings)
+    test_results = []
+    for _ in range(num_tests):
         (name, stdout, stderr, passed, duration) = job_queue.get_next()
-        all_passed = all_passed and passed
-        time_sum += duration
+        test_results.append((name, passed, duration))
+        if passed:
+            timings[name] = duration
 
         print('\n' + BOLD[1] + name + BOLD[0] + ":")
         print('' if passed else stdout + '\n', end='')
         print('' if stderr == '' else 'stderr:\n' + stderr + '\n', end='')
-        results += "%s | %s | %s s\n" % (name.ljust(max_len_name), str(passed).ljust(6), duration)
         print("Pass: %s%s%s, Duration: %s s\n" % (BOLD[1], passed, BOLD[0], duration))
-    results += BOLD[1] + "\n%s | %s | %s s (accumulated)" % ("ALL".ljust(max_len_name), str(all_passed).ljust(6), time_sum) + BOLD[0]
-    print(results)
+    all_passed = print_results(test_results)
     print("\nRuntime: %s s" % (int(time.time() - time0)))
+    if expected_makespan is not None:
+        print("Expected runtime from recorded timings: %s s" % expected_makespan)
+    print("Slot utilization: %.0f%% of %d %s" % (100 * job_queue.utilization(), job_queue.num_jobs,
+                                                 "nodes" if test_costs else "slots"))
+    if not shard and not instrumented():
+        # Shards record their durations when their results are merged
+        save_test_timings(timings)
+    if warm_pool:
+        print("Warm pool: %d of %d tests started on pre-started nodes" % (warm_pool.claimed, num_tests))
+        print("Warm pool: nodes took %.1f s to start, tests waited %.1f s for them: %.1f s of test time saved, "
+              "up to %.1f s of runtime" % (warm_pool.startup_time, warm_pool.wait_time,
+                                           warm_pool.startup_time - warm_pool.wait_time,
+                                           warm_pool.saved_slot_time / job_queue.num_jobs))
+        warm_pool.cleanup()
+    if shard:
+        write_results_file(test_results, shard)
 
     if coverage:
         coverage.report_rpc_coverage()
@@ -275,58 +387,511 @@ def runtests():
         print("Cleaning up coverage data")
         coverage.cleanup()
 
+    if profiledir:
+        report_python_hotspots(profiledir)
+
     sys.exit(not all_passed)
 
 
+def print_results(test_results):
+    """
+    Print the summary table for a list of (name, passed, duration) and
+    return whether all tests passed.
+    """
+    max_len_name = max([len("TEST")] + [len(name) for (name, _, _) in test_results])
+    all_passed = all(passed for (_, passed, _) in test_results)
+    time_sum = sum(duration for (_, _, duration) in test_results)
+    results = BOLD[1] + "%s | %s | %s\n\n" % ("TEST".ljust(max_len_name), "PASSED", "DURATION") + BOLD[0]
+    for (name, passed, duration) in test_results:
+        results += "%s | %s | %s s\n" % (name.ljust(max_len_name), str(passed).ljust(6), duration)
+    results += BOLD[1] + "\n%s | %s | %s s (accumulated)" % ("ALL".ljust(max_len_name), str(all_passed).ljust(6), time_sum) + BOLD[0]
+    print(results)
+    return all_passed
+
+
+def shard_tests(test_list, timings, num_shards):
+    """
+    Split test_list into num_shards lists with balanced total recorded
+    duration, by assigning the longest tests first to the shard with the
+    least work.  Tests without a recording count as the median recorded
+    duration.  Without timings, the tests are dealt round-robin in name
+    order.  The split only depends on test_list and timings.
+    """
+    if timings is None:
+        return [sorted(test_list)[i::num_shards] for i in range(num_shards)]
+    known = sorted(timings[t] for t in test_list if t in timings)
+    default = known[len(known) // 2] if known else 1
+    shards = [[] for _ in range(num_shards)]
+    loads = [0] * num_shards
+    for t in sorted(test_list, key=lambda t: (-timings.get(t, default), t)):
+        i = loads.index(min(loads))
+        shards[i].append(t)
+        loads[i] += timings.get(t, default)
+    return shards
+
+
+def instrumented():
+    """Whether coverage or profiling makes the durations of this run unrepresentative"""
+    return bool(ENABLE_COVERAGE or ENABLE_PROFILE)
+
+
+def write_results_file(test_results, shard):
+    filename = results_file or BUILDDIR + '/qa/rpc_test_results.shard%dof%d.json' % shard
+    with open(filename, 'w', encoding='utf8') as f:
+        json.dump({'shard': '%d/%d' % shard,
+                   'instrumented': instrumented(),
+                   'tests': [{'name': name, 'passed': passed, 'duration': duration}
+                             for (name, passed, duration) in test_results]}, f, indent=1)
+    print("Wrote results to %s" % filename)
+
+
+def merge_results(filenames):
+    """
+    Print the summary table of the results files of several shards, record
+    their durations in the --timingsfile or TIMINGS_FILE unless the shards
+    ran with coverage or profiling, and exit with failure unless all the
+    tests passed.  The files must be those of all n shards of one split,
+    each exactly once, or nothing is recorded.
+    """
+    shards = {}
+    for filename in filenames:
+        with open(filename, 'r', encoding='utf8') as f:
+            results = json.load(f)
+        match = RESULTS_SHARD_REGEX.match(str(results.get('shard')))
+        (i, n) = tuple(int(x) for x in match.groups()) if match else (0, 0)
+        if not 1 <= i <= n:
+            print("Invalid shard %r in %s" % (results.get('shard'), filename))
+            sys.exit(1)
+        if (i, n) in shards:
+            print("Shard %d/%d is in both %s and %s" % (i, n, shards[(i, n)][0], filename))
+            sys.exit(1)
+        shards[(i, n)] = (filename, results)
+    counts = set(n for (_, n) in shards)
+    if len(counts) != 1:
+        print("Results are from splits into different numbers of shards: %s" %
+              ", ".join("%d/%d" % key for key in sorted(shards)))
+        sys.exit(1)
+    n = counts.pop()
+    missing = [i for i in range(1, n + 1) if (i, n) not in shards]
+    if missing:
+        print("Missing results of shard %s of %d" % (", ".join(str(i) for i in missing), n))
+        sys.exit(1)
+
+    test_results = []
+    seen = {}
+    timings = load_test_timings(timings_file)
+    for key in sorted(shards):
+        (filename, results) = shards[key]
+        for t in results['tests']:
+            if t['name'] in seen:
+                print("%s ran in both %s and %s" % (t['name'], seen[t['name']], filename))
+                sys.exit(1)
+            seen[t['name']] = filename
+            test_results.append((t['name'], t['passed'], t['duration']))
+            if t['passed'] and not results.get('instrumented'):
+                timings[t['name']] = t['duration']
+    save_test_timings(timings, timings_file)
+    sys.exit(not print_results(test_results))
+
+
+def report_python_hotspots(profiledir, count=25):
+    """
+    Print the Python functions with the most own time summed over the
+    .pstats files of all tests in profiledir, and merge their sampled
+    stacks, if any, into profiledir/all.folded.
+    """
+    filenames = sorted(os.path.join(profiledir, f) for f in os.listdir(profiledir) if f.endswith('.pstats'))
+    if not filenames:
+        print("No profiles written to %s" % profiledir)
+        return
+    print("\nPython hot spots of %d tests (profiles in %s):" % (len(filenames), profiledir))
+    stats = pstats.Stats(*filenames, stream=sys.stdout)
+    stats.strip_dirs().sort_stats('tottime').print_stats(count)
+
+    stacks = collections.Counter()
+    for filename in os.listdir(profiledir):
+        if filename.endswith('.folded') and filename != 'all.folded':
+            with open(os.path.join(profiledir, filename), 'r', encoding='utf8') as f:
+                for line in f:
+                    (stack, _, samples) = line.rstrip('\n').rpartition(' ')
+                    stacks[stack] += int(samples)
+    if stacks:
+        with open(os.path.join(profiledir, 'all.folded'), 'w', encoding='utf8') as f:
+            for (stack, samples) in sorted(stacks.items()):
+                f.write("%s %d\n" % (stack, samples))
+        print("Merged sampled stacks into %s" % os.path.join(profiledir, 'all.folded'))
+
+
+def load_test_timings(filename=None):
+    """
+    Return the recorded test durations in seconds by test name from
+    filename (by default TIMINGS_FILE), or an empty dict if there are none.
+    """
+    filename = filename or TIMINGS_FILE
+    try:
+        with open(filename, 'r', encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_test_timings(timings, filename=None):
+    filename = filename or TIMINGS_FILE
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(timings, f, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def schedule_tests(test_list, timings):
+    """
+    Order tests longest-processing-time first by their recorded durations.
+    Tests without a recording go first, in their static order, since they
+    may be long.
+    """
+    unknown = [t for t in test_list if t not in timings]
+    known = sorted((t for t in test_list if t in timings), key=timings.get, reverse=True)
+    return unknown + known
+
+
+def read_test_script(test):
+    with open(RPC_TESTS_DIR + test.split()[0], 'r', encoding='utf8') as f:
+        return f.read()
+
+
+def test_num_nodes(test):
+    """
+    Return the number of dogecoinds the test script starts, taken from its
+    largest "self.num_nodes = N" assignment (the framework default is 4).
+    """
+    counts = [int(n) for n in NUM_NODES_REGEX.findall(read_test_script(test))]
+    return max(counts + [1]) if counts else 4
+
+
+def node_budget():
+    """
+    Return how many dogecoinds to run at once: NODES_PER_CPU per core,
+    limited by available memory where it can be determined.
+    """
+    budget = NODES_PER_CPU * (os.cpu_count() or 1)
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            meminfo = dict(line.split(':', 1) for line in f)
+        available_mb = int(meminfo['MemAvailable'].split()[0]) // 1024
+        budget = min(budget, available_mb // NODE_MEMORY_MB)
+    except (OSError, KeyError, ValueError):
+        pass
+    return max(1, budget)
+
+
+def pick_next_test(test_list, costs, available, idle):
+    """
+    Return the index of the first test in test_list whose cost fits in the
+    available budget (any test fits when nothing is running), or None.
+    """
+    for i, t in enumerate(test_list):
+        if idle or costs.get(t, 1) <= available:
+            return i
+    return None
+
+
+def estimate_makespan(test_list, timings, budget, costs=None):
+    """
+    Return the wall time for running test_list in order within budget, or
+    None if some test has no recorded duration.  This mirrors
+    RPCTestHandler: whenever a test finishes, the first pending tests that
+    fit are started.
+    """
+    if any(t not in timings for t in test_list):
+        return None
+    costs = costs or {}
+    pending = list(test_list)
+    running = []  # heap of (end time, cost)
+    now = used = 0
+    while pending or running:
+        while True:
+            i = pick_next_test(pending, costs, budget - used, not running)
+            if i is None:
+                break
+            t = pending.pop(i)
+            heapq.heappush(running, (now + timings[t], costs.get(t, 1)))
+            used += costs.get(t, 1)
+        (now, cost) = heapq.heappop(running)
+        used -= cost
+    return now
+
+
+class WarmPool:
+    """
+    Starts the dogecoinds of an upcoming test ahead of time, on a copy of
+    the cached chain in the tmpdir and with the port seed that test will be
+    given, so their startup overlaps with the tests already running.  The
+    test adopts them with --warmpool (see util.spawn_dogecoind), replacing
+    any it needs to start with other arguments.
+
+    Every test gets fresh nodes: a node shared between tests could not be
+    reset to the cached state (wallet transactions, mempool, peers and
+    mocktime all survive an invalidateblock back to the cache tip).
+    """
+
+    def __init__(self, cachedir):
+        sys.path.insert(0, RPC_TESTS_DIR)
+        from test_framework import util
+        self.util = util
+        self.cachedir = cachedir
+        self.root = tempfile.mkdtemp(prefix="warmpool")
+        # Nodes are prepared on a worker thread, so the runner can go on
+        # handling tests that finish meanwhile.  One at a time, as util
+        # keeps the port seed and mocktime in globals.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.prepared = {}
+        self.claimed = 0
+        # Seconds the claimed nodes took to start, and that tests waited
+        # for them, and the test runtime saved in slot seconds (see
+        # RPCTestHandler)
+        self.startup_time = 0
+        self.wait_time = 0
+        self.saved_slot_time = 0
+
+    def prepare(self, test, port_seed):
+        """Start the nodes for test in the background, unless it builds its own chain"""
+        if test in self.prepared or CLEAN_CHAIN_REGEX.search(read_test_script(test)):
+            return
+        self.prepared[test] = self.executor.submit(self._prepare, test, port_seed)
+
+    def _prepare(self, test, port_seed):
+        """
+        Start the nodes for test and wait for their RPC to come up.  Returns
+        the extra test arguments, the processes and the stderr files of the
+        nodes, and the seconds they took to start, or None if they failed to
+        start, in which case the test starts its own.
+        """
+        start_time = time.time()
+        util = self.util
+        util.PortSeed.n = port_seed
+        root = os.path.join(self.root, str(port_seed))
+        tmpdir = os.path.join(root, str(port_seed))
+        num_nodes = min(test_num_nodes(test), util.MAX_NODES)
+        # The nodes' stderr is passed on to the test's when it is done, as
+        # anything written there fails the test
+        stderr_files = [os.path.join(self.root, "%d.node%d.stderr" % (port_seed, i)) for i in range(num_nodes)]
+        processes = []
+        try:
+            util.initialize_chain(tmpdir, num_nodes, self.cachedir)
+            for i in range(num_nodes):
+                with open(stderr_files[i], 'w', encoding='utf8') as stderr:
+                    processes.append(subprocess.Popen(util.dogecoind_args(i, tmpdir), stdout=subprocess.DEVNULL,
+                                                      stderr=stderr))
+                threading.Thread(target=self._record_exit, args=(processes[i], os.path.join(tmpdir, "node" + str(i))),
+                                 daemon=True).start()
+            with open(os.path.join(tmpdir, util.WARM_NODES_FILE), 'w', encoding='utf8') as f:
+                json.dump({"nodes": {os.path.join(tmpdir, "node" + str(i)): p.pid for i, p in enumerate(processes)},
+                           "mocktime": util.get_mocktime(),
+                           "cachedir": self.cachedir}, f)
+            util.disable_mocktime()
+            for (i, process) in enumerate(processes):
+                util.wait_for_dogecoind_start(process, util.rpc_url(i), i)
+        except Exception as e:
+            print("Warm nodes for %s failed to start: %s" % (test, e))
+            self.reap(processes, stderr_files[:len(processes)])
+            return None
+        return (["--tmpdir=" + root, "--warmpool", "--portseed=%d" % port_seed], processes, stderr_files,
+                time.time() - start_time)
+
+    def _record_exit(self, process, datadir):
+        """
+        Write the exit status of a node to its datadir for the test as soon
+        as it exits, and only then reap it, so that the test can't mistake
+        another process that reuses the pid for the node (see
+        util.WarmProcess)
+        """
+        try:
+            info = os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+            returncode = info.si_status if info.si_code == os.CLD_EXITED else -info.si_status
+        except (AttributeError, ChildProcessError):
+            # No waitid, or already reaped by reap() once the test was done
+            returncode = process.wait()
+        filename = os.path.join(datadir, self.util.WARM_EXIT_FILE)
+        try:
+            with open(filename + '.tmp', 'w', encoding='utf8') as f:
+                f.write(str(returncode))
+            os.replace(filename + '.tmp', filename)
+        except OSError:
+            # The test is done and its tmpdir removed
+            pass
+        process.wait()
+
+    def claim(self, test):
+        """
+        Return a future for the result of _prepare() for test, or None if
+        its nodes were not prepared.
+        """
+        return self.prepared.pop(test, None)
+
+    @staticmethod
+    def reap(processes, stderr_files=()):
+        """
+        Wait for the nodes the test stopped and stop those it didn't, and
+        return what they wrote to stderr.
+        """
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+            try:
+                process.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        stderr = ""
+        for filename in stderr_files:
+            with open(filename, 'r', encoding='utf8', errors='replace') as f:
+                stderr += f.read()
+        return stderr
+
+    def cleanup(self):
+        for future in self.prepared.values():
+            warm = future.result()
+            if warm:
+                self.reap(*warm[1:3])
+        self.prepared = {}
+        self.executor.shutdown()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
 class RPCTestHandler:
     """
     Trigger the testscripts passed in via the list.
     """
 
-    def __init__(self, num_tests_parallel, test_list=None, flags=None):
+    def __init__(self, num_tests_parallel, test_list=None, flags=None, test_costs=None, warm_pool=None, timings=None):
+        """
+        With test_costs (a cost per test name, 1 if missing), num_tests_parallel
+        is the total cost of the tests allowed to run at once.  timings, the
+        recorded test durations, tell the warm pool which test is next.
+        """
         assert(num_tests_parallel >= 1)
         self.num_jobs = num_tests_parallel
         self.test_list = test_list
         self.flags = flags
+        self.test_costs = test_costs or {}
+        self.warm_pool = warm_pool
+        self.timings = timings or {}
         self.num_running = 0
         # In case there is a graveyard of zombie dogecoinds, we can apply a
         # pseudorandom offset to hopefully jump over them.
         # (625 is PORT_RANGE/MAX_NODES)
         self.portseed_offset = int(time.time() * 1000) % 625
-        self.jobs = []
+        # Start times of the running tests by name
+        self.jobs = {}
+        # Tests are started, and put here once they exit, by a thread each
+        self.finished = queue.Queue()
+        # Port seeds for prepared warm nodes, above those of ordinary launches
+        self.warm_seeds = itertools.count(len(test_list or []) + 1)
+        self.start_time = None
+        self.busy_time = 0
+
+    def utilization(self):
+        """
+        Return the fraction of slot time spent running tests since the
+        first test was started.
+        """
+        if self.start_time is None:
+            return 0
+        return self.busy_time / (self.num_jobs * (time.time() - self.start_time))
+
+    def _next_test(self):
+        i = pick_next_test(self.test_list, self.test_costs, self.num_jobs - self.num_running,
+                           self.num_running == 0)
+        return None if i is None else self.test_list.pop(i)
+
+    def _predict_next_test(self):
+        """
+        Return the test _next_test will start once the running test expected
+        to finish first is done, going by the recorded durations (running
+        tests without one are expected to finish last, in start order).
+        """
+        if not self.jobs:
+            i = pick_next_test(self.test_list, self.test_costs, self.num_jobs - self.num_running, True)
+        else:
+            name = min(self.jobs, key=lambda t: (self.jobs[t] + self.timings.get(t, math.inf), self.jobs[t]))
+            cost = self.test_costs.get(name, 1)
+            i = pick_next_test(self.test_list, self.test_costs, self.num_jobs - self.num_running + cost,
+                               self.num_running == cost)
+        return None if i is None else self.test_list[i]
+
+    def _run_job(self, name, port_seed, warm):
+        """
+        Run the test, on the warm nodes if warm (a future from
+        WarmPool.claim) gets some, and put its results in self.finished,
+        with the startup and wait time of the warm nodes, if any.
+        Waiting for warm nodes and stopping the ones the test left running
+        happen here rather than in get_next, which keeps handling the tests
+        that finish meanwhile.
+        """
+        time0 = time.time()
+        stdout = stderr = ""
+        returncode = 1
+        warm_times = None
+        try:
+            warm = warm.result() if warm else None
+            if warm:
+                (port_seed, processes, stderr_files, startup_time) = warm
+                warm_times = (startup_time, time.time() - time0)
+            with tempfile.SpooledTemporaryFile(max_size=2**16) as log_stdout, \
+                 tempfile.SpooledTemporaryFile(max_size=2**16) as log_stderr:
+                try:
+                    returncode = subprocess.call(['python3']+(RPC_TESTS_DIR + name).split() + self.flags + port_seed,
+                                                 universal_newlines=True,
+                                                 stdout=log_stdout,
+                                                 stderr=log_stderr)
+                finally:
+                    log_stdout.seek(0), log_stderr.seek(0)
+                    [stdout, stderr] = [l.read().decode('utf-8') for l in (log_stdout, log_stderr)]
+                    if warm:
+                        stderr += self.warm_pool.reap(processes, stderr_files)
+        except Exception:
+            stderr += traceback.format_exc()
+        self.finished.put((name, time0, returncode, stdout, stderr, warm_times))
 
     def get_next(self):
-        while self.num_running < self.num_jobs and self.test_list:
+        while True:
             # Add tests
-            self.num_running += 1
-            t = self.test_list.pop(0)
+            t = self._next_test()
+            if t is None:
+                break
+            self.num_running += self.test_costs.get(t, 1)
             port_seed = ["--portseed={}".format(len(self.test_list) + self.portseed_offset)]
-            log_stdout = tempfile.SpooledTemporaryFile(max_size=2**16)
-            log_stderr = tempfile.SpooledTemporaryFile(max_size=2**16)
-            self.jobs.append((t,
-                              time.time(),
-                              subprocess.Popen(['python3']+(RPC_TESTS_DIR + t).split() + self.flags + port_seed,
-                                               universal_newlines=True,
-                                               stdout=log_stdout,
-                                               stderr=log_stderr),
-                              log_stdout,
-                              log_stderr))
+            warm = self.warm_pool.claim(t) if self.warm_pool else None
+            self.jobs[t] = time.time()
+            if self.start_time is None:
+                self.start_time = self.jobs[t]
+            threading.Thread(target=self._run_job, args=(t, port_seed, warm), daemon=True).start()
+        next_test = self._predict_next_test() if self.warm_pool else None
+        if next_test is not None:
+            self.warm_pool.prepare(next_test, next(self.warm_seeds) + self.portseed_offset)
         if not self.jobs:
             raise IndexError('pop from empty list')
         while True:
             # Return first proc that finishes
-            time.sleep(.5)
-            for j in self.jobs:
-                (name, time0, proc, log_out, log_err) = j
-                if proc.poll() is not None:
-                    log_out.seek(0), log_err.seek(0)
-                    [stdout, stderr] = [l.read().decode('utf-8') for l in (log_out, log_err)]
-                    log_out.close(), log_err.close()
-                    passed = stderr == "" and proc.returncode == 0
-                    self.num_running -= 1
-                    self.jobs.remove(j)
-                    return name, stdout, stderr, passed, int(time.time() - time0)
-            print('.', end='', flush=True)
+            try:
+                (name, time0, returncode, stdout, stderr, warm_times) = self.finished.get(timeout=.5)
+            except queue.Empty:
+                print('.', end='', flush=True)
+                continue
+            duration = time.time() - time0
+            passed = stderr == "" and returncode == 0
+            if warm_times:
+                # The test would have spent the startup time starting its
+                # nodes itself, less what it waited for the warm ones
+                (startup_time, wait_time) = warm_times
+                self.warm_pool.claimed += 1
+                self.warm_pool.startup_time += startup_time
+                self.warm_pool.wait_time += wait_time
+                self.warm_pool.saved_slot_time += (startup_time - wait_time) * self.test_costs.get(name, 1)
+            self.num_running -= self.test_costs.get(name, 1)
+            self.busy_time += duration * self.test_costs.get(name, 1)
+            del self.jobs[name]
+            return name, stdout, stderr, passed, int(duration)
 
 
 class RPCCoverage(object):
@@ -335,8 +900,9 @@ class RPCCoverage(object):
 
     Coverage calculation works by having each test script subprocess write
     coverage files into a particular directory. These files contain the RPC
-    commands invoked during testing, as well as a complete listing of RPC
-    commands per `dogecoin-cli help` (`rpc_interface.txt`).
+    commands invoked during testing, with their call counts and cumulative
+    time, as well as a complete listing of RPC commands per
+    `dogecoin-cli help` (`rpc_interface.txt`).
 
     After all tests complete, the commands run are combined and diff'd against
     the complete list to calculate uncovered RPC commands.
@@ -361,6 +927,22 @@ class RPCCoverage(object):
         else:
             print("All RPC commands covered.")
 
+        self.report_rpc_hotspots()
+
+    def report_rpc_hotspots(self, count=20):
+        """
+        Print the RPC commands with the most cumulative call time.
+
+        """
+        (calls, seconds) = self._get_rpc_call_stats()
+        if not calls:
+            return
+        print("Slowest RPC commands by cumulative time:")
+        print("  %-32s %8s %10s %10s" % ("command", "calls", "total(s)", "avg(ms)"))
+        for cmd in sorted(seconds, key=seconds.get, reverse=True)[:count]:
+            print("  %-32s %8d %10.2f %10.2f" % (cmd, calls[cmd], seconds[cmd],
+                                                 1000 * seconds[cmd] / calls[cmd]))
+
     def cleanup(self):
         return shutil.rmtree(self.dir)
 
@@ -391,10 +973,31 @@ class RPCCoverage(object):
 
         for filename in coverage_filenames:
             with open(filename, 'r') as f:
-                covered_cmds.update([i.strip() for i in f.readlines()])
+                covered_cmds.update([i.split()[0] for i in f if i.strip()])
 
         return all_cmds - covered_cmds
 
+    def _get_rpc_call_stats(self):
+        """
+        Return the total calls to and seconds spent in each RPC command.
+
+        """
+        calls = collections.Counter()
+        seconds = collections.Counter()
+        for root, dirs, files in os.walk(self.dir):
+            for filename in files:
+                if filename.startswith('coverage.'):
+                    with open(os.path.join(root, filename), 'r') as f:
+                        for line in f:
+                            fields = line.split()
+                            if len(fields) == 3:
+                                calls[fields[0]] += int(fields[1])
+                                seconds[fields[0]] += float(fields[2])
+        return (calls, seconds)
+
 
 if __name__ == '__main__':
-    runtests()
+    if merge_files:
+        merge_results(merge_files)
+    else:
+        runtests()
@@ -14,9 +14,9 @@ class LongpollThread(threading.Thread):
         # query current longpollid
         templat = node.getblocktemplate()
         self.longpollid = templat['longpollid']
-        # create a new connection to the node, we can't use the same
-        # connection from two threads
-        self.node = get_rpc_proxy(node.url, 1, timeout=600)
+        # node is a pooled proxy, which the test goes on using while this
+        # thread waits in the longpoll
+        self.node = node
 
     def run(self):
         self.node.getblocktemplate({'longpollid':self.longpollid})
@@ -33,6 +33,9 @@ class GetBlockTemplateLPTest(BitcoinTestFramework):
 
     def run_test(self):
         print("Warning: this test will take about 70 seconds in the best case. Be patient.")
+        # A thread-safe proxy to node0, shared by the longpoll threads and
+        # the calls the test makes on node0 while they wait
+        node = get_rpc_proxy(self.nodes[0].url, 0, timeout=600, pooled=True)
         self.nodes[0].generate(10)
         templat = self.nodes[0].getblocktemplate()
         longpollid = templat['longpollid']
@@ -41,7 +44,7 @@ class GetBlockTemplateLPTest(BitcoinTestFramework):
         assert(templat2['longpollid'] == longpollid)
 
         # Test 1: test that the longpolling wait if we do nothing
-        thr = LongpollThread(self.nodes[0])
+        thr = LongpollThread(node)
         thr.start()
         # check that thread still lives
         thr.join(5)  # wait 5 seconds or until thread exits
@@ -54,14 +57,14 @@ class GetBlockTemplateLPTest(BitcoinTestFramework):
         assert(not thr.is_alive())
 
         # Test 3: test that longpoll will terminate if we generate a block ourselves
-        thr = LongpollThread(self.nodes[0])
+        thr = LongpollThread(node)
         thr.start()
-        self.nodes[0].generate(1)  # generate a block on another node
+        node.generate(1)  # generate a block on the same node, through the same proxy
         thr.join(5)  # wait 5 seconds or until thread exits
         assert(not thr.is_alive())
 
         # Test 4: test that introducing a new transaction into the mempool will terminate the longpoll
-        thr = LongpollThread(self.nodes[0])
+        thr = LongpollThread(node)
         thr.start()
         # generate a random transaction and submit it
         (txid, txhex, fee) = random_transaction(self.nodes, Decimal("1.1"), Decimal("0.0"), Decimal("0.001"), 20)
@@ -23,7 +23,7 @@ class MempoolLimitTest(BitcoinTestFramework):
         self.setup_clean_chain = True
         self.num_nodes = 1
 
-        self.txouts = gen_return_txouts()
+        self.txouts = gen_return_ctxouts()
 
     def run_test(self):
         txids = []
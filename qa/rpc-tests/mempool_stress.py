@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# Copyright (c) 2023 The Dogecoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+#
+# Mempool stress harness
+#
+# Fills the mempool of a node with graphs of transactions built by
+# MiniWallet (long chains, wide fan-outs and packages at the ancestor and
+# descendant limits), submits them over RPC or P2P at a target rate, and
+# records the acceptance latency, rejections by reason, evictions and
+# getmempoolinfo over time.  The graphs and fee rates only depend on
+# --seed, so runs are repeatable and can be compared across builds.
+#
+# This is a benchmark rather than a regression test; rpc-tests.py -extended
+# only runs a short submission over P2P, to keep that path working.
+# Example:
+#
+#   qa/rpc-tests/mempool_stress.py --graph=mixed --count=30000 --rate=1000 \
+#       --maxmempool=5 --report=/tmp/stress.json
+#
+
+import collections
+import json
+import random
+import threading
+import time
+
+from test_framework.mininode import *
+from test_framework.miniwallet import MiniWallet, DEFAULT_FEE_RATE
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import *
+
+MAX_ANCESTORS = 25
+MAX_DESCENDANTS = 25
+
+GRAPHS = ('chain', 'fanout', 'package', 'mixed')
+
+# Value of each output funding one graph
+GRAPH_FUNDING = 100 * COIN
+
+# Outputs per funding transaction, which keeps it well below the
+# standard transaction size
+FUNDING_OUTPUTS = 500
+
+# Over P2P, the node is pinged after this many transactions to measure
+# how long it took to process them
+P2P_WINDOW = 100
+
+
+class TestNode(SingleNodeConnCB):
+    def __init__(self):
+        SingleNodeConnCB.__init__(self)
+        self.pong = threading.Event()
+        self.rejects = []
+
+    def on_pong(self, conn, message):
+        self.last_pong = message
+        if message.nonce == self.ping_counter:
+            self.pong.set()
+
+    def on_reject(self, conn, message):
+        self.rejects.append(message)
+
+    def ping(self, timeout=60):
+        """Send a ping and wait until the node has answered it"""
+        self.pong.clear()
+        self.send_message(msg_ping(nonce=self.ping_counter))
+        if not self.pong.wait(timeout):
+            raise AssertionError("No pong within %d seconds" % timeout)
+        self.ping_counter += 1
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {'p%d_ms' % p: round(1000 * values[min(len(values) - 1, len(values) * p // 100)], 3)
+              for p in (50, 90, 99)}
+    result['max_ms'] = round(1000 * values[-1], 3)
+    return result
+
+
+class MempoolStressTest(BitcoinTestFramework):
+
+    def __init__(self):
+        super().__init__()
+        self.setup_clean_chain = False
+        self.num_nodes = 1
+
+    def add_options(self, parser):
+        parser.add_option("--graph", dest="graph", default="mixed", type="choice", choices=GRAPHS,
+                          help="Shape of the transaction graphs: %s (default: %%default)" % ", ".join(GRAPHS))
+        parser.add_option("--count", dest="count", default=2000, type="int",
+                          help="Number of transactions to submit (default: %default)")
+        parser.add_option("--chainlength", dest="chain_length", default=MAX_ANCESTORS, type="int",
+                          help="Transactions per chain (default: %default)")
+        parser.add_option("--fanout", dest="fanout", default=MAX_DESCENDANTS - 1, type="int",
+                          help="Children per fan-out parent (default: %default)")
+        parser.add_option("--rate", dest="rate", default=0, type="float",
+                          help="Transactions per second to submit, 0 for as fast as possible (default: %default)")
+        parser.add_option("--via", dest="via", default="rpc", type="choice", choices=("rpc", "p2p"),
+                          help="Submit with sendrawtransaction or as P2P tx messages (default: %default)")
+        parser.add_option("--maxmempool", dest="maxmempool", default=300, type="int",
+                          help="-maxmempool of the node in MB (default: %default)")
+        parser.add_option("--pollinterval", dest="poll_interval", default=0.5, type="float",
+                          help="Seconds between getmempoolinfo samples (default: %default)")
+        parser.add_option("--seed", dest="seed", default=1, type="int",
+                          help="Seed for the graphs and fee rates (default: %default)")
+        parser.add_option("--signed", dest="signed", default=False, action="store_true",
+                          help="Spend P2PKH outputs with signatures instead of P2SH(OP_TRUE)")
+        parser.add_option("--report", dest="report",
+                          help="Write the results to this file as JSON")
+
+    def setup_network(self):
+        self.nodes = start_nodes(1, self.options.tmpdir,
+                                 [["-maxmempool=%d" % self.options.maxmempool, "-maxorphantx=1000",
+                                   "-whitelist=127.0.0.1"]])
+        self.is_network_split = False
+        if self.options.via == "p2p":
+            self.test_node = TestNode()
+            self.test_node.add_connection(NodeConn('127.0.0.1', p2p_port(0), self.nodes[0], self.test_node))
+            NetworkThread().start()
+            self.test_node.wait_for_verack()
+
+    def spend(self, utxos, fee_rate, num_outputs=1):
+        """Create a transaction spending utxos, and return it with its outputs"""
+        tx = self.wallet.create_transaction(utxos, num_outputs=num_outputs, fee_rate=fee_rate)
+        outputs = [self.wallet.utxos.pop() for _ in range(num_outputs)]
+        return (tx, outputs[::-1])
+
+    def build_chain(self, utxo, fee_rate):
+        """chainlength transactions, each spending the one before"""
+        txs = []
+        for _ in range(self.options.chain_length):
+            (tx, [utxo]) = self.spend([utxo], fee_rate)
+            txs.append(tx)
+        return txs
+
+    def build_fanout(self, utxo, fee_rate):
+        """A parent with fanout outputs, each spent by a child"""
+        (parent, outputs) = self.spend([utxo], fee_rate, self.options.fanout)
+        return [parent] + [self.spend([output], fee_rate)[0] for output in outputs]
+
+    def build_package(self, utxo, fee_rate):
+        """
+        A root whose outputs start four chains, which together reach the
+        descendant limit of the root
+        """
+        branches = 4
+        (root, outputs) = self.spend([utxo], fee_rate, branches)
+        txs = [root]
+        for output in outputs:
+            for _ in range((MAX_DESCENDANTS - 1) // branches):
+                (tx, [output]) = self.spend([output], fee_rate)
+                txs.append(tx)
+        return txs
+
+    def build_graphs(self, rng, funding):
+        builders = {'chain': self.build_chain, 'fanout': self.build_fanout, 'package': self.build_package}
+        txs = []
+        while len(txs) < self.options.count:
+            graph = self.options.graph if self.options.graph != 'mixed' else rng.choice(sorted(builders))
+            # Exponentially distributed from 1-128 times the default fee
+            # rate, so that a full mempool has something to evict
+            fee_rate = int(DEFAULT_FEE_RATE * 1.1892 ** rng.randint(0, 28))
+            txs += builders[graph](funding.pop(), fee_rate)
+        return txs[:self.options.count]
+
+    def fund(self, num_outputs):
+        node = self.nodes[0]
+        while num_outputs > 0:
+            self.wallet.fund(GRAPH_FUNDING * min(num_outputs, FUNDING_OUTPUTS), min(num_outputs, FUNDING_OUTPUTS))
+            num_outputs -= FUNDING_OUTPUTS
+        node.generate(1)
+        funding = list(self.wallet.utxos)
+        self.wallet.utxos.clear()
+        return funding
+
+    def sample_mempool(self, start, samples, stop):
+        """Append getmempoolinfo to samples until stop is set, and once more after"""
+        node = self.rpc
+        while True:
+            stopped = stop.is_set()
+            info = node.getmempoolinfo()
+            samples.append({'time': round(time.time() - start, 3),
+                            'size': info['size'],
+                            'bytes': info['bytes'],
+                            'usage': info['usage'],
+                            'mempoolminfee': float(info['mempoolminfee'])})
+            if stopped:
+                return
+            stop.wait(self.options.poll_interval)
+
+    def wait_for_slot(self, start, i):
+        if self.options.rate:
+            delay = start + i / self.options.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def submit_rpc(self, txs, start, rejects):
+        """Send txs with sendrawtransaction, returning the accepted txids and per-tx latencies"""
+        node = self.rpc
+        accepted = []
+        latencies = []
+        for (i, tx) in enumerate(txs):
+            self.wait_for_slot(start, i)
+            t = time.time()
+            try:
+                accepted.append(node.sendrawtransaction(tx, True))
+            except JSONRPCException as e:
+                rejects[e.error['message']] += 1
+            latencies.append(time.time() - t)
+        return (accepted, latencies)
+
+    def submit_p2p(self, txs, start, rejects):
+        """
+        Send txs as tx messages, returning the accepted txids and, per
+        window of P2P_WINDOW transactions, the time from its first
+        message to the pong that follows it, divided by its size.
+        """
+        latencies = []
+        for window in range(0, len(txs), P2P_WINDOW):
+            t = time.time()
+            for (i, tx) in enumerate(txs[window:window + P2P_WINDOW], window):
+                self.wait_for_slot(start, i)
+                self.test_node.send_message(msg_tx(tx))
+            self.test_node.ping()
+            size = min(P2P_WINDOW, len(txs) - window)
+            latencies += [(time.time() - t) / size] * size
+        rejected = set()
+        for reject in self.test_node.rejects:
+            rejects[reject.reason.decode('utf-8', 'replace')] += 1
+            rejected.add("%064x" % reject.data)
+        return ([tx.hash for tx in txs if tx.hash not in rejected], latencies)
+
+    def run_test(self):
+        rng = random.Random(self.options.seed)
+        self.wallet = MiniWallet(self.nodes[0], signed=self.options.signed)
+
+        # Each graph spends a confirmed output of its own; small graphs
+        # are 1 + fanout or chainlength transactions
+        graph_size = min(self.options.chain_length, self.options.fanout + 1, MAX_DESCENDANTS)
+        funding = self.fund(-(-self.options.count // graph_size))
+
+        t = time.time()
+        txs = self.build_graphs(rng, funding)
+        build_seconds = time.time() - t
+        print("Built %d transactions in %.2f s" % (len(txs), build_seconds))
+
+        # Shared by the submitting and the sampling threads
+        self.rpc = get_rpc_proxy(self.nodes[0].url, 0, pooled=True)
+        samples = []
+        stop = threading.Event()
+        rejects = collections.Counter()
+        start = time.time()
+        sampler = threading.Thread(target=self.sample_mempool, args=(start, samples, stop))
+        sampler.start()
+        try:
+            if self.options.via == "rpc":
+                (accepted, latencies) = self.submit_rpc([ToHex(tx) for tx in txs], start, rejects)
+            else:
+                (accepted, latencies) = self.submit_p2p(txs, start, rejects)
+            submit_seconds = time.time() - start
+        finally:
+            stop.set()
+            sampler.join()
+
+        # Accepted transactions missing from the mempool were evicted, as
+        # nothing is mined while submitting.  Over P2P, where the node only
+        # reports rejections, this also counts transactions left orphaned
+        mempool = set(self.nodes[0].getrawmempool())
+        evicted = sum(1 for txid in accepted if txid not in mempool)
+        assert_equal(len(accepted) + sum(rejects.values()), len(txs))
+
+        report = {
+            'options': {name: getattr(self.options, name) for name in
+                        ('graph', 'count', 'chain_length', 'fanout', 'rate', 'via', 'maxmempool', 'seed', 'signed')},
+            'build_seconds': round(build_seconds, 3),
+            'submit_seconds': round(submit_seconds, 3),
+            'submitted': len(txs),
+            'rate': round(len(txs) / submit_seconds, 1),
+            'accepted': len(accepted),
+            'evicted': evicted,
+            'rejected': dict(rejects),
+            'latency': percentiles(latencies),
+            'mempool': samples,
+        }
+        print("Submitted %d transactions over %s in %.2f s (%.0f tx/s)" % (len(txs), self.options.via, submit_seconds, report['rate']))
+        print("Accepted %d, evicted %d, rejected %d" % (len(accepted), evicted, sum(rejects.values())))
+        for (reason, count) in rejects.most_common():
+            print("  %6d %s" % (count, reason))
+        print("Acceptance latency: %s" % ", ".join("%s %s" % item for item in report['latency'].items()))
+        if samples:
+            print("Mempool at the end: %d transactions, %d bytes, %d bytes of memory" %
+                  (samples[-1]['size'], samples[-1]['bytes'], samples[-1]['usage']))
+        if self.options.report:
+            with open(self.options.report, 'w', encoding='utf8') as f:
+                json.dump(report, f, indent=1)
+            print("Wrote report to %s" % self.options.report)
+
+
+if __name__ == '__main__':
+    MempoolStressTest().main()
@@ -377,24 +377,15 @@ class CompactBlocksTest(BitcoinTestFramework):
         # Check that the cmpctblock message announced all the transactions.
         assert_equal(len(header_and_shortids.prefilled_txn) + len(header_and_shortids.shortids), len(block.vtx))
 
-        # And now check that all the shortids are as expected as well.
-        # Determine the siphash keys to use.
-        [k0, k1] = header_and_shortids.get_siphash_keys()
-
-        index = 0
-        while index < len(block.vtx):
-            if (len(header_and_shortids.prefilled_txn) > 0 and
-                    header_and_shortids.prefilled_txn[0].index == index):
-                # Already checked prefilled transactions above
-                header_and_shortids.prefilled_txn.pop(0)
-            else:
-                tx_hash = block.vtx[index].sha256
-                if version == 2:
-                    tx_hash = block.vtx[index].calc_sha256(True)
-                shortid = calculate_shortid(k0, k1, tx_hash)
-                assert_equal(shortid, header_and_shortids.shortids[0])
-                header_and_shortids.shortids.pop(0)
-            index += 1
+        # And now check that all the shortids are as expected as well, by
+        # reconstructing the block from its own transactions.
+        mempool = {tx.sha256: tx for tx in block.vtx[1:]}
+        partial_block = PartiallyDownloadedBlock(header_and_shortids, mempool, use_witness=(version == 2))
+        assert_equal(partial_block.mempool_collisions, 0)
+        assert_equal(partial_block.get_missing_indexes(), [])
+        reconstructed = partial_block.fill_block(BlockTransactions(block_hash, []))
+        assert(reconstructed is not None)
+        assert_equal([tx.sha256 for tx in reconstructed.vtx], [tx.sha256 for tx in block.vtx])
 
     # Test that dogecoind requests compact blocks when we announce new blocks
     # via header or inv, and that responding to getblocktxn causes the block
@@ -473,13 +464,22 @@ class CompactBlocksTest(BitcoinTestFramework):
     def test_getblocktxn_requests(self, node, test_node, version):
         with_witness = (version==2)
 
-        def test_getblocktxn_response(compact_block, peer, expected_result):
+        def test_getblocktxn_response(compact_block, peer, expected_result, mempool=None):
             msg = msg_cmpctblock(compact_block.to_p2p())
             peer.send_and_ping(msg)
             with mininode_lock:
                 assert(peer.last_getblocktxn is not None)
                 absolute_indexes = peer.last_getblocktxn.block_txn_request.to_absolute()
             assert_equal(absolute_indexes, expected_result)
+            # Given the same mempool, we should ask for the same transactions
+            partial_block = PartiallyDownloadedBlock(compact_block, mempool or {}, use_witness=with_witness)
+            assert_equal(partial_block.get_missing_indexes(), expected_result)
+            return partial_block
+
+        def test_fill_block(partial_block, block_transactions, block):
+            reconstructed = partial_block.fill_block(block_transactions)
+            assert(reconstructed is not None)
+            assert_equal(reconstructed.sha256, block.sha256)
 
         def test_tip_after_message(node, peer, msg, tip):
             peer.send_and_ping(msg)
@@ -494,12 +494,13 @@ class CompactBlocksTest(BitcoinTestFramework):
         comp_block = HeaderAndShortIDs()
         comp_block.initialize_from_block(block, use_witness=with_witness)
 
-        test_getblocktxn_response(comp_block, test_node, [1, 2, 3, 4, 5])
+        partial_block = test_getblocktxn_response(comp_block, test_node, [1, 2, 3, 4, 5])
 
         msg_bt = msg_blocktxn()
         if with_witness:
             msg_bt = msg_witness_blocktxn() # serialize with witnesses
         msg_bt.block_transactions = BlockTransactions(block.sha256, block.vtx[1:])
+        test_fill_block(partial_block, msg_bt.block_transactions, block)
         test_tip_after_message(node, test_node, msg_bt, block.sha256)
 
         utxo = self.utxos.pop(0)
@@ -508,8 +509,9 @@ class CompactBlocksTest(BitcoinTestFramework):
 
         # Now try interspersing the prefilled transactions
         comp_block.initialize_from_block(block, prefill_list=[0, 1, 5], use_witness=with_witness)
-        test_getblocktxn_response(comp_block, test_node, [2, 3, 4])
+        partial_block = test_getblocktxn_response(comp_block, test_node, [2, 3, 4])
         msg_bt.block_transactions = BlockTransactions(block.sha256, block.vtx[2:5])
+        test_fill_block(partial_block, msg_bt.block_transactions, block)
         test_tip_after_message(node, test_node, msg_bt, block.sha256)
 
         # Now try giving one transaction ahead of time.
@@ -522,9 +524,11 @@ class CompactBlocksTest(BitcoinTestFramework):
         # Prefill 4 out of the 6 transactions, and verify that only the one
         # that was not in the mempool is requested.
         comp_block.initialize_from_block(block, prefill_list=[0, 2, 3, 4], use_witness=with_witness)
-        test_getblocktxn_response(comp_block, test_node, [5])
+        partial_block = test_getblocktxn_response(comp_block, test_node, [5],
+                                                  {block.vtx[1].sha256: block.vtx[1]})
 
         msg_bt.block_transactions = BlockTransactions(block.sha256, [block.vtx[5]])
+        test_fill_block(partial_block, msg_bt.block_transactions, block)
         test_tip_after_message(node, test_node, msg_bt, block.sha256)
 
         # Now provide all transactions to the node before the block is
@@ -19,7 +19,7 @@ class PrioritiseTransactionTest(BitcoinTestFramework):
         self.setup_clean_chain = True
         self.num_nodes = 2
 
-        self.txouts = gen_return_txouts()
+        self.txouts = gen_return_ctxouts()
 
     def setup_network(self):
         self.nodes = []
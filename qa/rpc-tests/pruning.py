@@ -12,12 +12,7 @@
 # This test takes 20 mins or more (up to 2 hours)
 # ********
 from test_framework.blocktools import create_coinbase
-from test_framework.mininode import CBlock
-from test_framework.script import (
-    CScript,
-    OP_NOP,
-    OP_RETURN,
-)
+from test_framework.mininode import CBlock, filler_script
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import (
     start_node,
@@ -47,7 +42,7 @@ def mine_large_blocks(node, n):
         mine_large_blocks.nTime = 0
         
     # Get the block parameters for the first block
-    big_script = CScript([OP_RETURN] + [OP_NOP] * 950000)
+    big_script = filler_script(950001)
     best_block = node.getblock(node.getbestblockhash())
     height = int(best_block["height"]) + 1
     mine_large_blocks.nTime = max(mine_large_blocks.nTime, int(best_block["time"])) + 1
@@ -10,23 +10,22 @@
 #
 
 from .script import hash256, hash160, sha256, CScript, OP_0
-from .util import bytes_to_hex_str, hex_str_to_bytes
+from .util import hex_str_to_bytes
 
 chars = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 
 def byte_to_base58(b, version):
     result = ''
-    str = bytes_to_hex_str(b)
-    str = bytes_to_hex_str(chr(version).encode('latin-1')) + str
-    checksum = bytes_to_hex_str(hash256(hex_str_to_bytes(str)))
-    str += checksum[:8]
-    value = int('0x'+str,0)
+    data = bytes([version]) + b
+    data += hash256(data)[:4]
+    value = int.from_bytes(data, 'big')
     while value > 0:
-        result = chars[value % 58] + result
-        value //= 58
-    while (str[:2] == '00'):
+        value, mod = divmod(value, 58)
+        result = chars[mod] + result
+    for byte in data:
+        if byte != 0:
+            break
         result = chars[0] + result
-        str = str[2:]
     return result
 
 # TODO: def base58_decode
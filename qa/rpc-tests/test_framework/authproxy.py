@@ -7,11 +7,15 @@
 
   - HTTP connections persist for the life of the AuthServiceProxy object
     (if server supports HTTP/1.1)
+  - PooledAuthServiceProxy shares a bounded pool of keep-alive connections
+    per URL and is safe to call from multiple threads
   - sends protocol 'version', per JSON-RPC 1.1
   - sends proper, incrementing 'id'
+  - batch() queues calls and sends them as one JSON-RPC batch request
   - sends Basic HTTP authentication headers
   - parses all JSON numbers that look like floats as Decimal
-  - uses standard Python json lib
+  - uses standard Python json lib, or simplejson/rapidjson for responses
+    if selected with TEST_RPC_JSON_CODEC
 
   Previous copyright, from python-jsonrpc/jsonrpc/proxy.py:
 
@@ -40,9 +44,13 @@ except ImportError:
     import httplib
 import base64
 import decimal
+import itertools
 import json
 import logging
+import os
 import socket
+import threading
+import time
 try:
     import urllib.parse as urlparse
 except ImportError:
@@ -52,8 +60,36 @@ USER_AGENT = "AuthServiceProxy/0.1"
 
 HTTP_TIMEOUT = 30
 
+# Maximum number of connections a PooledAuthServiceProxy opens per URL
+POOL_MAX_CONNECTIONS = 8
+
 log = logging.getLogger("DogecoinRPC")
 
+def _load_json_decoder(codec):
+    """
+    Return a function decoding a JSON response string with every
+    non-integer number parsed as an exact decimal.Decimal.
+    """
+    if codec == "json":
+        return lambda data: json.loads(data, parse_float=decimal.Decimal)
+    if codec == "simplejson":
+        import simplejson
+        return lambda data: simplejson.loads(data, use_decimal=True)
+    if codec == "rapidjson":
+        import rapidjson
+        return lambda data: rapidjson.loads(data, number_mode=rapidjson.NM_DECIMAL)
+    raise ValueError("Unknown TEST_RPC_JSON_CODEC %r" % codec)
+
+# Which JSON library decodes RPC responses: "json" (the default) is the
+# standard library, "simplejson" and "rapidjson" are used if installed and
+# fall back to "json" otherwise. Requests are always encoded with json.
+JSON_CODEC = os.getenv("TEST_RPC_JSON_CODEC", "json")
+try:
+    json_loads = _load_json_decoder(JSON_CODEC)
+except ImportError:
+    JSON_CODEC = "json"
+    json_loads = _load_json_decoder(JSON_CODEC)
+
 class JSONRPCException(Exception):
     def __init__(self, rpc_error):
         try:
@@ -69,19 +105,40 @@ def EncodeDecimal(o):
         return str(o)
     raise TypeError(repr(o) + " is not JSON serializable")
 
+def new_connection(url, timeout):
+    """Return an unconnected HTTP(S)Connection for the parsed URL"""
+    port = 80 if url.port is None else url.port
+    if url.scheme == 'https':
+        return httplib.HTTPSConnection(url.hostname, port, timeout=timeout)
+    return httplib.HTTPConnection(url.hostname, port, timeout=timeout)
+
+def get_result(response):
+    """Return the result of a decoded JSON-RPC response or raise its error"""
+    if response.get('error') is not None:
+        raise JSONRPCException(response['error'])
+    elif 'result' not in response:
+        raise JSONRPCException({
+            'code': -343, 'message': 'missing JSON-RPC result'})
+    else:
+        return response['result']
+
 class AuthServiceProxy(object):
-    __id_count = 0
+    # next() on a count is atomic, so ids stay unique across threads
+    __id_count = itertools.count(1)
 
     # ensure_ascii: escape unicode as \uXXXX, passed to json.dumps
-    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, ensure_ascii=True):
+    # pool: a ConnectionPool, used by PooledAuthServiceProxy instead of a
+    # connection of its own
+    # on_transfer: called with the method name (None for a batch) and the
+    # sizes of the HTTP request and response bodies of each request made
+    # by this proxy or the callables derived from it
+    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, ensure_ascii=True, pool=None,
+                 on_transfer=None):
         self.__service_url = service_url
         self._service_name = service_name
         self.ensure_ascii = ensure_ascii # can be toggled on the fly by tests
+        self.on_transfer = on_transfer
         self.__url = urlparse.urlparse(service_url)
-        if self.__url.port is None:
-            port = 80
-        else:
-            port = self.__url.port
         (user, passwd) = (self.__url.username, self.__url.password)
         try:
             user = user.encode('utf8')
@@ -94,15 +151,14 @@ class AuthServiceProxy(object):
         authpair = user + b':' + passwd
         self.__auth_header = b'Basic ' + base64.b64encode(authpair)
 
-        if connection:
+        if pool is not None:
+            # Connections are checked out of the pool for each call
+            self.__conn = None
+        elif connection:
             # Callables re-use the connection of the original proxy
             self.__conn = connection
-        elif self.__url.scheme == 'https':
-            self.__conn = httplib.HTTPSConnection(self.__url.hostname, port,
-                                                  timeout=timeout)
         else:
-            self.__conn = httplib.HTTPConnection(self.__url.hostname, port,
-                                                 timeout=timeout)
+            self.__conn = new_connection(self.__url, timeout)
 
     def __getattr__(self, name):
         if name.startswith('__') and name.endswith('__'):
@@ -110,9 +166,27 @@ class AuthServiceProxy(object):
             raise AttributeError
         if self._service_name is not None:
             name = "%s.%s" % (self._service_name, name)
-        return AuthServiceProxy(self.__service_url, name, connection=self.__conn)
+        return AuthServiceProxy(self.__service_url, name, connection=self.__conn, on_transfer=self.on_transfer)
 
-    def _request(self, method, path, postdata):
+    def _get_connection(self):
+        return self.__conn
+
+    def _release_connection(self, conn, reusable):
+        pass
+
+    def _request(self, method, path, postdata, service_name=None):
+        conn = self._get_connection()
+        try:
+            (response, bytes_received) = self._request_on(conn, method, path, postdata)
+        except:
+            self._release_connection(conn, False)
+            raise
+        self._release_connection(conn, True)
+        if self.on_transfer is not None:
+            self.on_transfer(service_name, len(postdata), bytes_received)
+        return response
+
+    def _request_on(self, conn, method, path, postdata):
         '''
         Do a HTTP request, with retry if we get disconnected (e.g. due to a timeout).
         This is a workaround for https://bugs.python.org/issue3566 which is fixed in Python 3.5.
@@ -122,57 +196,71 @@ class AuthServiceProxy(object):
                    'Authorization': self.__auth_header,
                    'Content-type': 'application/json'}
         try:
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
+            conn.request(method, path, postdata, headers)
+            return self._get_response(conn)
         except httplib.BadStatusLine as e:
-            if e.line == "''": # if connection was closed, try again
-                self.__conn.close()
-                self.__conn.request(method, path, postdata, headers)
-                return self._get_response()
+            # RemoteDisconnected: the server closed a kept-alive connection,
+            # typically one that was idle in a ConnectionPool
+            if e.line == "''" or isinstance(e, httplib.RemoteDisconnected): # if connection was closed, try again
+                conn.close()
+                conn.request(method, path, postdata, headers)
+                return self._get_response(conn)
             else:
                 raise
         except (BrokenPipeError,ConnectionResetError):
             # Python 3.5+ raises BrokenPipeError instead of BadStatusLine when the connection was reset
             # ConnectionResetError happens on FreeBSD with Python 3.4
-            self.__conn.close()
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
+            conn.close()
+            conn.request(method, path, postdata, headers)
+            return self._get_response(conn)
+
+    @staticmethod
+    def _next_id():
+        return next(AuthServiceProxy.__id_count)
 
     def __call__(self, *args, **argsn):
-        AuthServiceProxy.__id_count += 1
+        id_count = AuthServiceProxy._next_id()
 
-        log.debug("-%s-> %s %s"%(AuthServiceProxy.__id_count, self._service_name,
-                                 json.dumps(args or argsn, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
+        # Only serialise for the debug log if it will actually be written
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("-%s-> %s %s"%(id_count, self._service_name,
+                                     json.dumps(args or argsn, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
         if args and argsn:
             raise ValueError('Cannot handle both named and positional arguments')
         postdata = json.dumps({'version': '1.1',
                                'method': self._service_name,
                                'params': args or argsn,
-                               'id': AuthServiceProxy.__id_count}, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
-        response = self._request('POST', self.__url.path, postdata.encode('utf-8'))
-        if response['error'] is not None:
-            raise JSONRPCException(response['error'])
-        elif 'result' not in response:
-            raise JSONRPCException({
-                'code': -343, 'message': 'missing JSON-RPC result'})
-        else:
-            return response['result']
+                               'id': id_count}, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
+        response = self._request('POST', self.__url.path, postdata.encode('utf-8'), self._service_name)
+        return get_result(response)
+
+    def batch(self, on_send=None):
+        """
+        Return an RPCBatch that queues calls made on it and sends them in
+        one request, either explicitly or when used as a context manager:
+
+            with node.batch() as b:
+                hashes = [b.getblockhash(i) for i in range(10)]
+            hashes = [h.result() for h in hashes]
+        """
+        return RPCBatch(self, on_send)
 
     def _batch(self, rpc_call_list):
         postdata = json.dumps(list(rpc_call_list), default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
-        log.debug("--> "+postdata)
+        log.debug("--> %s", postdata)
         return self._request('POST', self.__url.path, postdata.encode('utf-8'))
 
-    def _get_response(self):
+    def _get_response(self, conn):
+        '''Return the decoded response and the size of its body'''
         try:
-            http_response = self.__conn.getresponse()
+            http_response = conn.getresponse()
         except socket.timeout as e:
             raise JSONRPCException({
                 'code': -344,
                 'message': '%r RPC took longer than %f seconds. Consider '
                            'using larger timeout for calls that take '
                            'longer to return.' % (self._service_name,
-                                                  self.__conn.timeout)})
+                                                  conn.timeout)})
         if http_response is None:
             raise JSONRPCException({
                 'code': -342, 'message': 'missing HTTP response from server'})
@@ -182,10 +270,185 @@ class AuthServiceProxy(object):
             raise JSONRPCException({
                 'code': -342, 'message': 'non-JSON HTTP response with \'%i %s\' from server' % (http_response.status, http_response.reason)})
 
-        responsedata = http_response.read().decode('utf8')
-        response = json.loads(responsedata, parse_float=decimal.Decimal)
-        if "error" in response and response["error"] is None:
-            log.debug("<-%s- %s"%(response["id"], json.dumps(response["result"], default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
+        body = http_response.read()
+        responsedata = body.decode('utf8')
+        response = json_loads(responsedata)
+        if log.isEnabledFor(logging.DEBUG):
+            if "error" in response and response["error"] is None:
+                log.debug("<-%s- %s"%(response["id"], json.dumps(response["result"], default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
+            else:
+                log.debug("<-- %s", responsedata)
+        return (response, len(body))
+
+class ConnectionPool(object):
+    """
+    Bounded pool of keep-alive connections to one RPC server URL.  get()
+    blocks while max_connections connections are checked out.
+    """
+
+    def __init__(self, service_url, timeout=HTTP_TIMEOUT, max_connections=POOL_MAX_CONNECTIONS):
+        self.service_url = service_url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.__url = urlparse.urlparse(service_url)
+        self.__idle = []
+        self.__opened = 0
+        self.__cond = threading.Condition()
+
+    def get(self):
+        with self.__cond:
+            while not self.__idle and self.__opened >= self.max_connections:
+                self.__cond.wait()
+            if self.__idle:
+                return self.__idle.pop()
+            self.__opened += 1
+        return new_connection(self.__url, self.timeout)
+
+    def put(self, conn):
+        with self.__cond:
+            self.__idle.append(conn)
+            self.__cond.notify()
+
+    def discard(self, conn):
+        """Close a connection in an unknown state instead of reusing it"""
+        conn.close()
+        with self.__cond:
+            self.__opened -= 1
+            self.__cond.notify()
+
+    def close(self):
+        with self.__cond:
+            for conn in self.__idle:
+                conn.close()
+            self.__opened -= len(self.__idle)
+            self.__idle = []
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_connection_pool(service_url, timeout=HTTP_TIMEOUT, max_connections=POOL_MAX_CONNECTIONS):
+    """Return the shared ConnectionPool for service_url, creating it if needed"""
+    with _pools_lock:
+        key = (service_url, timeout, max_connections)
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(service_url, timeout, max_connections)
+        return pool
+
+class PooledAuthServiceProxy(AuthServiceProxy):
+    """
+    AuthServiceProxy that checks a connection out of a shared pool for
+    each call, so one proxy (and the method proxies derived from it) can
+    be used from several threads at once.
+    """
+
+    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, pool=None, ensure_ascii=True, on_transfer=None):
+        if pool is None:
+            pool = get_connection_pool(service_url, timeout)
+        self.pool = pool
+        AuthServiceProxy.__init__(self, service_url, service_name, timeout, ensure_ascii=ensure_ascii, pool=pool,
+                                  on_transfer=on_transfer)
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internal stuff
+            raise AttributeError
+        if self._service_name is not None:
+            name = "%s.%s" % (self._service_name, name)
+        return PooledAuthServiceProxy(self.pool.service_url, name, pool=self.pool, ensure_ascii=self.ensure_ascii,
+                                      on_transfer=self.on_transfer)
+
+    def _get_connection(self):
+        return self.pool.get()
+
+    def _release_connection(self, conn, reusable):
+        if reusable:
+            self.pool.put(conn)
         else:
-            log.debug("<-- "+responsedata)
-        return response
+            self.pool.discard(conn)
+
+class RPCFuture(object):
+    """The pending result of a call queued on an RPCBatch"""
+
+    def __init__(self, method):
+        self.method = method
+        self.__response = None
+
+    def done(self):
+        return self.__response is not None
+
+    def set_response(self, response):
+        self.__response = response
+
+    def result(self):
+        """Return the call's result, raising its JSONRPCException if it failed"""
+        if self.__response is None:
+            raise RuntimeError("%s: batch has not been sent" % self.method)
+        return get_result(self.__response)
+
+class RPCBatch(object):
+    """
+    Queue of RPC calls sent to the server as a single JSON-RPC batch.
+    Each queued call returns an RPCFuture, filled in by send() from the
+    response with the matching id.  on_send, if given, is called with the
+    list of method names and the seconds the request took once it is
+    done, whether it succeeded or not.
+    """
+
+    def __init__(self, proxy, on_send=None):
+        self.__proxy = proxy
+        self.__on_send = on_send
+        self.__calls = []
+        self.__futures = {}
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internal stuff
+            raise AttributeError
+        return lambda *args, **argsn: self.call(name, *args, **argsn)
+
+    def __len__(self):
+        return len(self.__calls)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+
+    def call(self, method, *args, **argsn):
+        if args and argsn:
+            raise ValueError('Cannot handle both named and positional arguments')
+        id_count = AuthServiceProxy._next_id()
+        self.__calls.append({'version': '1.1',
+                             'method': method,
+                             'params': args or argsn,
+                             'id': id_count})
+        future = self.__futures[id_count] = RPCFuture(method)
+        return future
+
+    def send(self):
+        """Send the queued calls and fill in their futures"""
+        calls, futures = self.__calls, self.__futures
+        self.__calls, self.__futures = [], {}
+        if not calls:
+            return
+        start_time = time.time()
+        try:
+            responses = self.__proxy._batch(calls)
+        finally:
+            if self.__on_send is not None:
+                self.__on_send([c['method'] for c in calls], time.time() - start_time)
+        if isinstance(responses, dict):
+            # The server rejected the batch as a whole
+            get_result(responses)
+            raise JSONRPCException({
+                'code': -343, 'message': 'unexpected non-array batch response'})
+        for response in responses:
+            if response.get('id') in futures:
+                futures[response['id']].set_response(response)
+        for future in futures.values():
+            if not future.done():
+                future.set_response({'error': {
+                    'code': -343, 'message': 'missing JSON-RPC result'}})
@@ -5,9 +5,17 @@
 
 # General code for auxpow testing.  This includes routines to
 # solve an auxpow and to generate auxpow blocks.
+#
+# Internally everything works on bytes and integer targets; the hex string
+# functions are kept as the interface used by the tests.
 
 import binascii
 import hashlib
+import multiprocessing
+import struct
+
+# Number of nonces handed to a worker at a time when grinding in parallel.
+NONCE_CHUNK = 1 << 12
 
 def computeAuxpow (block, target, ok):
   """
@@ -15,47 +23,104 @@ def computeAuxpow (block, target, ok):
   (ok = True) or doesn't solve (ok = False) the block.
   """
 
+  auxpow = buildAuxpow (binascii.unhexlify (block), int (target, 16), 1,
+                        ok, doubleHash)
+  return binascii.hexlify (auxpow).decode ("ascii")
+
+def buildAuxpow (block, target, version, ok, powHash, processes=None):
+  """
+  Build the serialised auxpow (as bytes) for the child block hash block
+  (as bytes), with a parent block of the given version whose powHash
+  is below (ok = True) or above (ok = False) the integer target.
+  """
+
+  return AuxpowBuilder (version, powHash, processes).build (block, target, ok)
+
+class AuxpowBuilder (object):
+  """
+  Build auxpows for a sequence of child blocks with the same parent block
+  version (and thus chain id).  The coinbase and parent header parts that
+  don't depend on the child block are serialised once, so each block only
+  patches in its hash, the resulting merkle root and the nonce.
+  """
+
+  def __init__ (self, version, powHash, processes=None):
+    self.powHash = powHash
+    self.processes = processes
+
+    # Split the coinbase around the 32-byte child block hash.
+    tx = coinbaseTx (b"\x00" * 32)
+    offset = tx.index (b"\xfa\xbe" + b"m" * 2) + 4
+    self.txPrefix = tx[:offset]
+    self.txSuffix = tx[offset + 32:]
+
+    # The parent header is version + hashPrevBlock, the merkle root and
+    # nTime + nBits; solveHeader appends the nonce.
+    header = parentHeader (version, b"\x00" * 32)
+    self.headerPrefix = header[:36]
+    self.headerSuffix = header[68:76]
+
+  def build (self, block, target, ok):
+    """
+    Build the serialised auxpow (as bytes) for the child block hash block
+    (as bytes) that solves (ok = True) or doesn't solve (ok = False) the
+    integer target.
+    """
+
+    tx = self.txPrefix + block + self.txSuffix
+    header = solveHeader (self.headerPrefix + doubleHash (tx) + self.headerSuffix,
+                          target, ok, self.powHash, self.processes)
+
+    # MerkleTx part (block hash, empty branch, index) followed by the
+    # empty chain merkle branch and index, and the parent header.
+    return tx + doubleHash (header)[::-1] + b"\x00" * 10 + header
+
+  def mine (self, node, ok=True):
+    """
+    Get an auxblock from the given RPC connection, solve it and submit
+    it.  Returns the result of the submission.
+    """
+
+    auxblock = node.getauxblock ()
+    target = int.from_bytes (binascii.unhexlify (auxblock['target']), "little")
+    apow = self.build (binascii.unhexlify (auxblock['hash']), target, ok)
+    return node.getauxblock (auxblock['hash'], binascii.hexlify (apow).decode ("ascii"))
+
+def coinbaseTx (block):
+  """
+  Build the merge-mining coinbase transaction (as bytes) committing
+  to the child block hash block.
+  """
+
   # Start by building the merge-mining coinbase.  The merkle tree
   # consists only of the block hash as root.
-  coinbase = "fabe" + binascii.hexlify("m" * 2)
+  coinbase = b"\xfa\xbe" + b"m" * 2
   coinbase += block
-  coinbase += "01000000" + ("00" * 4)
+  coinbase += b"\x01\x00\x00\x00" + (b"\x00" * 4)
 
   # Construct "vector" of transaction inputs.
-  vin = "01"
-  vin += ("00" * 32) + ("ff" * 4)
-  vin += ("%02x" % (len (coinbase) / 2)) + coinbase
-  vin += ("ff" * 4)
+  vin = b"\x01"
+  vin += (b"\x00" * 32) + (b"\xff" * 4)
+  vin += bytes ([len (coinbase)]) + coinbase
+  vin += (b"\xff" * 4)
 
   # Build up the full coinbase transaction.  It consists only
   # of the input and has no outputs.
-  tx = "01000000" + vin + "00" + ("00" * 4)
-  txHash = doubleHashHex (tx)
-
-  # Construct the parent block header.  It need not be valid, just good
-  # enough for auxpow purposes.
-  header = "01000000"
-  header += "00" * 32
-  header += reverseHex (txHash)
-  header += "00" * 4
-  header += "00" * 4
-  header += "00" * 4
-
-  # Mine the block.
-  (header, blockhash) = mineBlock (header, target, ok)
-
-  # Build the MerkleTx part of the auxpow.
-  auxpow = tx
-  auxpow += blockhash
-  auxpow += "00"
-  auxpow += "00" * 4
-
-  # Extend to full auxpow.
-  auxpow += "00"
-  auxpow += "00" * 4
-  auxpow += header
-
-  return auxpow
+  return b"\x01\x00\x00\x00" + vin + b"\x00" + (b"\x00" * 4)
+
+def parentHeader (version, merkleRoot):
+  """
+  Construct the parent block header.  It need not be valid, just good
+  enough for auxpow purposes.  The nonce is left at zero.
+  """
+
+  header = struct.pack ("<I", version)
+  header += b"\x00" * 32
+  header += merkleRoot
+  header += b"\x00" * 4
+  header += b"\x00" * 4
+  header += b"\x00" * 4
+  return header
 
 def mineAuxpowBlock (node):
   """
@@ -68,37 +133,66 @@ def mineAuxpowBlock (node):
   res = node.getauxblock (auxblock['hash'], apow)
   assert res
 
+def solveHeader (header, target, ok, powHash, processes=None):
+  """
+  Given an 80-byte block header, search the full 32-bit nonce space
+  until powHash of the header is ok (or not) for the integer target.
+  With processes > 1 the search is split across a process pool, in
+  which case powHash must be picklable.  Returns the solved header.
+  """
+
+  prefix = bytes (header[:76])
+  if processes is None or processes <= 1:
+    nonce = _searchNonces ((prefix, 0, 1 << 32, target, ok, powHash))
+  else:
+    chunks = ((prefix, start, min (start + NONCE_CHUNK, 1 << 32), target, ok, powHash)
+              for start in range (0, 1 << 32, NONCE_CHUNK))
+    with multiprocessing.Pool (processes) as pool:
+      for nonce in pool.imap (_searchNonces, chunks):
+        if nonce is not None:
+          break
+
+  if nonce is None:
+    raise RuntimeError ("No nonce satisfies the target")
+  return prefix + struct.pack ("<I", nonce)
+
+def _searchNonces (args):
+  """
+  Return the first nonce in [start, end) for which the header is ok (or
+  not) for the target, or None.
+  """
+
+  (prefix, start, end, target, ok, powHash) = args
+  for nonce in range (start, end):
+    value = int.from_bytes (powHash (prefix + struct.pack ("<I", nonce)), "little")
+    if (ok and value < target) or ((not ok) and value > target):
+      return nonce
+  return None
+
 def mineBlock (header, target, ok):
   """
   Given a block header, update the nonce until it is ok (or not)
   for the given target.
   """
 
-  data = bytearray (binascii.unhexlify (header))
-  while True:
-    assert data[79] < 255
-    data[79] += 1
-    hexData = binascii.hexlify (data)
+  data = solveHeader (binascii.unhexlify (header), int (target, 16), ok,
+                      doubleHash)
+  hexData = binascii.hexlify (data).decode ("ascii")
+  return (hexData, doubleHashHex (hexData))
 
-    blockhash = doubleHashHex (hexData)
-    if (ok and blockhash < target) or ((not ok) and blockhash > target):
-      break
+def doubleHash (data):
+  """
+  Perform Bitcoin's Double-SHA256 hash on the given bytes.
+  """
 
-  return (hexData, blockhash)
+  return hashlib.sha256 (hashlib.sha256 (data).digest ()).digest ()
 
 def doubleHashHex (data):
   """
   Perform Bitcoin's Double-SHA256 hash on the given hex string.
   """
 
-  hasher = hashlib.sha256 ()
-  hasher.update (binascii.unhexlify (data))
-  data = hasher.digest ()
-
-  hasher = hashlib.sha256 ()
-  hasher.update (data)
-
-  return reverseHex (hasher.hexdigest ())
+  return binascii.hexlify (doubleHash (binascii.unhexlify (data))[::-1]).decode ("ascii")
 
 def reverseHex (data):
   """
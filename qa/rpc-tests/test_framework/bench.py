@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# Copyright (c) 2023 The Dogecoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Benchmarks of the test framework's own hot paths, to check that changes to
+them are still worth it. Run from qa/rpc-tests:
+
+    python3 -m test_framework.bench [name ...]
+
+with the names of the benchmarks to run (default: all of them). Code that
+uses NumPy when it is installed is timed with and without it.
+
+"""
+import contextlib
+import random
+import sys
+import time
+
+from . import ripemd160, script, siphash
+from .address import key_to_p2pkh
+from .blocktools import create_block, create_coinbase
+from .mininode import (
+    BlockTransactions,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    HeaderAndShortIDs,
+    PartiallyDownloadedBlock,
+)
+
+
+def timed(f, *args):
+    """Return f(*args) and the seconds it took"""
+    t = time.perf_counter()
+    result = f(*args)
+    return (result, time.perf_counter() - t)
+
+
+@contextlib.contextmanager
+def without_numpy():
+    """Make siphash fall back to pure Python, as if NumPy was missing"""
+    saved = siphash.numpy
+    siphash.numpy = None
+    try:
+        yield
+    finally:
+        siphash.numpy = saved
+
+
+def numpy_variants():
+    """Yield (label, context manager) for each SipHash implementation available"""
+    if siphash.numpy is not None:
+        yield ("NumPy", contextlib.nullcontext())
+    yield ("fallback", without_numpy())
+
+
+@contextlib.contextmanager
+def pure_ripemd160():
+    """Make script use the pure Python RIPEMD160, as if OpenSSL lacked it"""
+    saved = script.ripemd160
+    script.ripemd160 = ripemd160.ripemd160
+    try:
+        yield
+    finally:
+        script.ripemd160 = saved
+
+
+def make_transactions(count, first=1):
+    """count distinct unsigned transactions, which is all shortids need"""
+    txs = []
+    for i in range(first, first + count):
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(i, 0))]
+        tx.vout = [CTxOut(i, b'\x51')]
+        tx.rehash()
+        txs.append(tx)
+    return txs
+
+
+def make_block(num_txs):
+    block = create_block(0x1234, create_coinbase(1), 1000)
+    block.vtx += make_transactions(num_txs)
+    block.hashMerkleRoot = block.calc_merkle_root()
+    block.rehash()
+    return block
+
+
+def bench_addresses(num_keys=100000, num_memo_keys=50000):
+    """
+    key_to_p2pkh of distinct compressed keys, and hash160 of keys that
+    fit in its memo the first time and when repeated.
+    """
+    rng = random.Random(1)
+    keys = [b'\x02' + rng.getrandbits(256).to_bytes(32, 'big') for _ in range(num_keys)]
+    memo_keys = keys[:min(num_memo_keys, script.HASH160_CACHE_SIZE)]
+
+    def encode_all():
+        for key in keys:
+            key_to_p2pkh(key)
+
+    def hash_all():
+        for key in memo_keys:
+            script.hash160(key)
+
+    variants = [("pure", pure_ripemd160())]
+    if script.ripemd160 is not ripemd160.ripemd160:
+        variants.insert(0, ("hashlib", contextlib.nullcontext()))
+    print("key_to_p2pkh of %d distinct keys, hash160 of %d keys" % (len(keys), len(memo_keys)))
+    for (label, context) in variants:
+        with context:
+            script._hash160_cached.cache_clear()
+            (_, encode) = timed(encode_all)
+            script._hash160_cached.cache_clear()
+            (_, first) = timed(hash_all)
+            (_, again) = timed(hash_all)
+        print("  %-8s  key_to_p2pkh %.2fs  hash160 %.3fs, repeated %.3fs" % (label, encode, first, again))
+    script._hash160_cached.cache_clear()
+
+
+def bench_shortids(block_size=10000):
+    """HeaderAndShortIDs.initialize_from_block, which hashes every tx with SipHash"""
+    block = make_block(block_size)
+    print("Short IDs of a %d-tx block" % len(block.vtx))
+    for (label, context) in numpy_variants():
+        with context:
+            (_, seconds) = timed(HeaderAndShortIDs().initialize_from_block, block)
+        print("  %-8s  %.3fs" % (label, seconds))
+
+
+def bench_reconstruct(block_size=2020, missing=20, mempool_sizes=(5000, 20000, 50000)):
+    """
+    PartiallyDownloadedBlock for a block whose transactions are in the
+    mempool but for the last missing ones: match is indexing the shortids
+    and scanning the mempool, total includes fill_block.
+    """
+    block = make_block(block_size)
+    compact_block = HeaderAndShortIDs()
+    compact_block.initialize_from_block(block, prefill_list=[0])
+    known = block.vtx[1:-missing]
+    absent = block.vtx[-missing:]
+    unrelated = make_transactions(max(mempool_sizes) - len(known), first=block_size + 1)
+
+    print("Reconstruction of a %d-tx block with %d txs missing" % (len(block.vtx), missing))
+    for size in mempool_sizes:
+        mempool = {tx.sha256: tx for tx in known + unrelated[:size - len(known)]}
+        for (label, context) in numpy_variants():
+            with context:
+                (partial_block, match) = timed(PartiallyDownloadedBlock, compact_block, mempool)
+                (filled, fill) = timed(partial_block.fill_block, BlockTransactions(block.sha256, absent))
+            assert filled is not None and filled.sha256 == block.sha256
+            print("  mempool %6d  %-8s  match %.3fs  total %.3fs" % (size, label, match, match + fill))
+
+
+BENCHMARKS = {
+    'addresses': bench_addresses,
+    'reconstruct': bench_reconstruct,
+    'shortids': bench_shortids,
+}
+
+
+def main(names):
+    for name in names or sorted(BENCHMARKS):
+        if name not in BENCHMARKS:
+            sys.exit("Unknown benchmark %s, choose from: %s" % (name, ", ".join(sorted(BENCHMARKS))))
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -10,51 +10,117 @@ interface.
 It provides a way to track which RPC commands are exercised during
 testing.
 
+Calls are counted in memory and written out by flush() when the test shuts
+down (and at exit), one "<method> <calls> <seconds>" line per RPC method, so
+the coverage files also show where a test spends its RPC time.
+
 """
+import atexit
+import collections
 import os
+import threading
+import time
+
+from . import rpcstats
 
 
 REFERENCE_FILENAME = 'rpc_interface.txt'
 
+# Per coverage logfile, the number of calls to and cumulative seconds spent
+# in each RPC method since the last flush()
+call_counts = collections.defaultdict(collections.Counter)
+call_times = collections.defaultdict(collections.Counter)
+stats_lock = threading.Lock()
+
+# Held while checking for and writing the reference file, which the threads
+# starting a test's nodes all try to write
+reference_lock = threading.Lock()
+
+
+def record_calls(coverage_logfile, rpc_methods, seconds=0):
+    """Count one call of each method, sharing seconds of latency between them"""
+    if not coverage_logfile or not rpc_methods:
+        return
+    with stats_lock:
+        for method in rpc_methods:
+            call_counts[coverage_logfile][method] += 1
+            call_times[coverage_logfile][method] += seconds / len(rpc_methods)
+
+
+def flush():
+    """Append the recorded calls to their coverage logfiles and reset them"""
+    with stats_lock:
+        for filename, counts in call_counts.items():
+            with open(filename, 'a+', encoding='utf8') as f:
+                f.write("".join("%s %d %.6f\n" % (method, count, call_times[filename][method])
+                                for method, count in sorted(counts.items())))
+        call_counts.clear()
+        call_times.clear()
+
+atexit.register(flush)
+
 
 class AuthServiceProxyWrapper(object):
     """
     An object that wraps AuthServiceProxy to record specific RPC calls.
 
     """
-    def __init__(self, auth_service_proxy_instance, coverage_logfile=None):
+    def __init__(self, auth_service_proxy_instance, coverage_logfile=None, stats_node=None):
         """
         Kwargs:
             auth_service_proxy_instance (AuthServiceProxy): the instance
                 being wrapped.
-            coverage_logfile (str): if specified, write each service_name
-                out to a file when called.
+            coverage_logfile (str): if specified, record each service_name
+                called, to be written out to this file by flush().
+            stats_node (int): if specified, record the latency of each
+                call in rpcstats under this node number (the proxy
+                reports the sizes, see util.get_rpc_proxy).
 
         """
         self.auth_service_proxy_instance = auth_service_proxy_instance
         self.coverage_logfile = coverage_logfile
+        self.stats_node = stats_node
 
     def __getattr__(self, *args, **kwargs):
         return_val = self.auth_service_proxy_instance.__getattr__(
             *args, **kwargs)
 
-        return AuthServiceProxyWrapper(return_val, self.coverage_logfile)
+        return AuthServiceProxyWrapper(return_val, self.coverage_logfile, self.stats_node)
 
     def __call__(self, *args, **kwargs):
         """
-        Delegates to AuthServiceProxy, then writes the particular RPC method
-        called to a file.
+        Delegates to AuthServiceProxy, then records the particular RPC method
+        called and how long it took.
 
         """
+        start_time = time.time()
         return_val = self.auth_service_proxy_instance.__call__(*args, **kwargs)
-        rpc_method = self.auth_service_proxy_instance._service_name
+        seconds = time.time() - start_time
 
-        if self.coverage_logfile:
-            with open(self.coverage_logfile, 'a+', encoding='utf8') as f:
-                f.write("%s\n" % rpc_method)
+        self.record_calls([self.auth_service_proxy_instance._service_name], seconds)
 
         return return_val
 
+    def batch(self):
+        """
+        Delegates to AuthServiceProxy.batch, recording each batched RPC
+        method when the batch is sent, with an equal share of the round
+        trip as its latency.
+
+        """
+        return self.auth_service_proxy_instance.batch(on_send=self.record_calls)
+
+    def record_calls(self, rpc_methods, seconds=0):
+        """
+        Record a call of each of rpc_methods, made in one request that took
+        seconds, for coverage and in the rpcstats of stats_node.
+
+        """
+        record_calls(self.coverage_logfile, rpc_methods, seconds)
+        if self.stats_node is not None:
+            for method in rpc_methods:
+                rpcstats.record(self.stats_node, method, seconds / len(rpc_methods))
+
     @property
     def url(self):
         return self.auth_service_proxy_instance.url
@@ -87,20 +153,25 @@ def write_all_rpc_commands(dirname, node):
     """
     filename = os.path.join(dirname, REFERENCE_FILENAME)
 
-    if os.path.isfile(filename):
-        return False
+    with reference_lock:
+        if os.path.isfile(filename):
+            return False
 
-    help_output = node.help().split('\n')
-    commands = set()
+        help_output = node.help().split('\n')
+        commands = set()
 
-    for line in help_output:
-        line = line.strip()
+        for line in help_output:
+            line = line.strip()
 
-        # Ignore blanks and headers
-        if line and not line.startswith('='):
-            commands.add("%s\n" % line.split()[0])
+            # Ignore blanks and headers
+            if line and not line.startswith('='):
+                commands.add("%s\n" % line.split()[0])
 
-    with open(filename, 'w', encoding='utf8') as f:
-        f.writelines(list(commands))
+        # Tests running in parallel share the directory, so the file is
+        # only ever seen complete
+        tmpname = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmpname, 'w', encoding='utf8') as f:
+            f.writelines(list(commands))
+        os.replace(tmpname, filename)
 
     return True
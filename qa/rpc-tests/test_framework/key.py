@@ -1,6 +1,6 @@
 # Copyright (c) 2011 Sam Rushing
 #
-# key.py - OpenSSL wrapper
+# key.py - OpenSSL wrapper and pure-Python secp256k1 fallback
 #
 # This file is modified from python-bitcoinlib.
 #
@@ -14,81 +14,101 @@ disk in swap! Use with caution!
 import ctypes
 import ctypes.util
 import hashlib
+import hmac
+import os
 import sys
+import unittest
 
-ssl = ctypes.cdll.LoadLibrary(ctypes.util.find_library ('ssl') or 'libeay32')
+# this specifies the curve used with ECDSA.
+NID_secp256k1 = 714 # from openssl/obj_mac.h
 
-ssl.BN_new.restype = ctypes.c_void_p
-ssl.BN_new.argtypes = []
+SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
 
-ssl.BN_bin2bn.restype = ctypes.c_void_p
-ssl.BN_bin2bn.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p]
+# Thx to Sam Devlin for the ctypes magic 64-bit fix.
+def _check_result(val, func, args):
+    if val == 0:
+        raise ValueError
+    else:
+        return ctypes.c_void_p (val)
 
-ssl.BN_CTX_free.restype = None
-ssl.BN_CTX_free.argtypes = [ctypes.c_void_p]
+def _load_openssl():
+    """Load libssl and declare the EC_KEY/ECDSA functions used below"""
+    ssl = ctypes.cdll.LoadLibrary(ctypes.util.find_library ('ssl') or 'libeay32')
 
-ssl.BN_CTX_new.restype = ctypes.c_void_p
-ssl.BN_CTX_new.argtypes = []
+    ssl.BN_new.restype = ctypes.c_void_p
+    ssl.BN_new.argtypes = []
 
-ssl.ECDH_compute_key.restype = ctypes.c_int
-ssl.ECDH_compute_key.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
+    ssl.BN_bin2bn.restype = ctypes.c_void_p
+    ssl.BN_bin2bn.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p]
 
-ssl.ECDSA_sign.restype = ctypes.c_int
-ssl.ECDSA_sign.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+    ssl.BN_CTX_free.restype = None
+    ssl.BN_CTX_free.argtypes = [ctypes.c_void_p]
 
-ssl.ECDSA_verify.restype = ctypes.c_int
-ssl.ECDSA_verify.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
+    ssl.BN_CTX_new.restype = ctypes.c_void_p
+    ssl.BN_CTX_new.argtypes = []
 
-ssl.EC_KEY_free.restype = None
-ssl.EC_KEY_free.argtypes = [ctypes.c_void_p]
+    ssl.ECDH_compute_key.restype = ctypes.c_int
+    ssl.ECDH_compute_key.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
-ssl.EC_KEY_new_by_curve_name.argtypes = [ctypes.c_int]
+    ssl.ECDSA_sign.restype = ctypes.c_int
+    ssl.ECDSA_sign.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.EC_KEY_get0_group.restype = ctypes.c_void_p
-ssl.EC_KEY_get0_group.argtypes = [ctypes.c_void_p]
+    ssl.ECDSA_verify.restype = ctypes.c_int
+    ssl.ECDSA_verify.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
 
-ssl.EC_KEY_get0_public_key.restype = ctypes.c_void_p
-ssl.EC_KEY_get0_public_key.argtypes = [ctypes.c_void_p]
+    ssl.EC_KEY_free.restype = None
+    ssl.EC_KEY_free.argtypes = [ctypes.c_void_p]
 
-ssl.EC_KEY_set_private_key.restype = ctypes.c_int
-ssl.EC_KEY_set_private_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    ssl.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
+    ssl.EC_KEY_new_by_curve_name.argtypes = [ctypes.c_int]
 
-ssl.EC_KEY_set_conv_form.restype = None
-ssl.EC_KEY_set_conv_form.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    ssl.EC_KEY_get0_group.restype = ctypes.c_void_p
+    ssl.EC_KEY_get0_group.argtypes = [ctypes.c_void_p]
 
-ssl.EC_KEY_set_public_key.restype = ctypes.c_int
-ssl.EC_KEY_set_public_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    ssl.EC_KEY_get0_public_key.restype = ctypes.c_void_p
+    ssl.EC_KEY_get0_public_key.argtypes = [ctypes.c_void_p]
 
-ssl.i2o_ECPublicKey.restype = ctypes.c_void_p
-ssl.i2o_ECPublicKey.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    ssl.EC_KEY_set_private_key.restype = ctypes.c_int
+    ssl.EC_KEY_set_private_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.EC_POINT_new.restype = ctypes.c_void_p
-ssl.EC_POINT_new.argtypes = [ctypes.c_void_p]
+    ssl.EC_KEY_set_conv_form.restype = None
+    ssl.EC_KEY_set_conv_form.argtypes = [ctypes.c_void_p, ctypes.c_int]
 
-ssl.EC_POINT_free.restype = None
-ssl.EC_POINT_free.argtypes = [ctypes.c_void_p]
+    ssl.EC_KEY_set_public_key.restype = ctypes.c_int
+    ssl.EC_KEY_set_public_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.EC_POINT_mul.restype = ctypes.c_int
-ssl.EC_POINT_mul.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+    ssl.i2o_ECPublicKey.restype = ctypes.c_void_p
+    ssl.i2o_ECPublicKey.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
 
-# this specifies the curve used with ECDSA.
-NID_secp256k1 = 714 # from openssl/obj_mac.h
+    ssl.EC_POINT_new.restype = ctypes.c_void_p
+    ssl.EC_POINT_new.argtypes = [ctypes.c_void_p]
 
-SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
-SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
+    ssl.EC_POINT_free.restype = None
+    ssl.EC_POINT_free.argtypes = [ctypes.c_void_p]
 
-# Thx to Sam Devlin for the ctypes magic 64-bit fix.
-def _check_result(val, func, args):
-    if val == 0:
-        raise ValueError
-    else:
-        return ctypes.c_void_p (val)
+    ssl.EC_POINT_mul.restype = ctypes.c_int
+    ssl.EC_POINT_mul.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
-ssl.EC_KEY_new_by_curve_name.errcheck = _check_result
+    ssl.EC_KEY_new_by_curve_name.errcheck = _check_result
+    return ssl
 
-class CECKey(object):
+# Which ECDSA implementation backs CECKey: "openssl" (the default) wraps
+# libssl through ctypes, "python" uses the pure-Python secp256k1 code in
+# PythonECKey. Set TEST_KEY_BACKEND=python to skip loading libssl entirely;
+# the Python backend is also used when libssl or its EC_KEY API is missing.
+KEY_BACKEND = os.getenv("TEST_KEY_BACKEND", "openssl")
+if KEY_BACKEND not in ("openssl", "python"):
+    raise ValueError("Unknown TEST_KEY_BACKEND %r" % KEY_BACKEND)
+
+ssl = None
+if KEY_BACKEND == "openssl":
+    try:
+        ssl = _load_openssl()
+    except (OSError, AttributeError):
+        KEY_BACKEND = "python"
+
+class OpenSSLECKey(object):
     """Wrapper around OpenSSL's EC_KEY"""
 
     POINT_CONVERSION_COMPRESSED = 2
@@ -194,6 +214,289 @@ class CECKey(object):
         ssl.EC_KEY_set_conv_form(self.k, form)
 
 
+# secp256k1 domain parameters (SEC 2, section 2.4.1)
+SECP256K1_FIELD_SIZE = 2**256 - 2**32 - 977
+SECP256K1_G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+               0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+def _modinv(a, m):
+    return pow(a, m - 2, m)
+
+# Points are affine (x, y) tuples, or None for the point at infinity. The
+# scalar multiplication loops accumulate in Jacobian (X, Y, Z) coordinates
+# to avoid a field inversion per step.
+
+def _affine_add(a, b):
+    p = SECP256K1_FIELD_SIZE
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a[0] == b[0]:
+        if (a[1] + b[1]) % p == 0:
+            return None
+        lam = 3 * a[0] * a[0] * _modinv(2 * a[1], p) % p
+    else:
+        lam = (b[1] - a[1]) * _modinv(b[0] - a[0], p) % p
+    x = (lam * lam - a[0] - b[0]) % p
+    return (x, (lam * (a[0] - x) - a[1]) % p)
+
+def _jacobian_double(a):
+    p = SECP256K1_FIELD_SIZE
+    x1, y1, z1 = a
+    if y1 == 0 or z1 == 0:
+        return (0, 1, 0)
+    yy = y1 * y1 % p
+    s = 4 * x1 * yy % p
+    m = 3 * x1 * x1 % p
+    x3 = (m * m - 2 * s) % p
+    y3 = (m * (s - x3) - 8 * yy * yy) % p
+    return (x3, y3, 2 * y1 * z1 % p)
+
+def _jacobian_add_affine(a, b):
+    """Add the affine point b to the Jacobian point a"""
+    p = SECP256K1_FIELD_SIZE
+    if b is None:
+        return a
+    x1, y1, z1 = a
+    if z1 == 0:
+        return (b[0], b[1], 1)
+    zz = z1 * z1 % p
+    u2 = b[0] * zz % p
+    s2 = b[1] * zz * z1 % p
+    h = (u2 - x1) % p
+    r = (s2 - y1) % p
+    if h == 0:
+        if r == 0:
+            return _jacobian_double(a)
+        return (0, 1, 0)
+    hh = h * h % p
+    hhh = h * hh % p
+    v = x1 * hh % p
+    x3 = (r * r - hhh - 2 * v) % p
+    y3 = (r * (v - x3) - y1 * hhh) % p
+    return (x3, y3, z1 * h % p)
+
+def _jacobian_to_affine(a):
+    p = SECP256K1_FIELD_SIZE
+    x, y, z = a
+    if z == 0:
+        return None
+    zinv = _modinv(z, p)
+    zinv2 = zinv * zinv % p
+    return (x * zinv2 % p, y * zinv2 * zinv % p)
+
+# Fixed-base table for the generator: _G_TABLE[i][j] == j * 16**i * G, so
+# k*G is the sum of one table entry per 4-bit window of k, with no doublings.
+_G_TABLE = None
+
+def _generator_table():
+    global _G_TABLE
+    if _G_TABLE is None:
+        table = []
+        base = SECP256K1_G
+        for _ in range(64):
+            row = [None, base]
+            for _ in range(14):
+                row.append(_affine_add(row[-1], base))
+            table.append(row)
+            base = _affine_add(row[-1], base)
+        _G_TABLE = table
+    return _G_TABLE
+
+def _mul_g(k):
+    table = _generator_table()
+    acc = (0, 1, 0)
+    for i in range(64):
+        acc = _jacobian_add_affine(acc, table[i][(k >> (4 * i)) & 15])
+    return _jacobian_to_affine(acc)
+
+def _mul(point, k):
+    """Multiply an arbitrary point with a 4-bit fixed window"""
+    row = [None, point]
+    for _ in range(14):
+        row.append(_affine_add(row[-1], point))
+    acc = (0, 1, 0)
+    for i in range(63, -1, -1):
+        for _ in range(4):
+            acc = _jacobian_double(acc)
+        acc = _jacobian_add_affine(acc, row[(k >> (4 * i)) & 15])
+    return _jacobian_to_affine(acc)
+
+def _decode_point(data):
+    p = SECP256K1_FIELD_SIZE
+    if len(data) == 33 and data[0] in (2, 3):
+        x = int.from_bytes(data[1:], 'big')
+        if x >= p:
+            return None
+        y2 = (x * x * x + 7) % p
+        y = pow(y2, (p + 1) // 4, p)
+        if y * y % p != y2:
+            return None
+        if (y & 1) != (data[0] & 1):
+            y = p - y
+        return (x, y)
+    if len(data) == 65 and data[0] == 4:
+        x = int.from_bytes(data[1:33], 'big')
+        y = int.from_bytes(data[33:], 'big')
+        if x >= p or y >= p or (y * y - x * x * x - 7) % p != 0:
+            return None
+        return (x, y)
+    return None
+
+def _encode_point(point, compressed):
+    if compressed:
+        return bytes([2 + (point[1] & 1)]) + point[0].to_bytes(32, 'big')
+    return b'\x04' + point[0].to_bytes(32, 'big') + point[1].to_bytes(32, 'big')
+
+def _der_encode_int(v):
+    return b'\x02' + bytes([(v.bit_length() + 8) // 8]) + v.to_bytes((v.bit_length() + 8) // 8, 'big')
+
+def _der_decode_sig(sig):
+    """Return (r, s) from a DER signature, or None if it is malformed"""
+    if len(sig) < 8 or sig[0] != 0x30 or sig[1] != len(sig) - 2:
+        return None
+    values = []
+    pos = 2
+    for _ in range(2):
+        if pos + 2 > len(sig) or sig[pos] != 0x02:
+            return None
+        size = sig[pos + 1]
+        if size == 0 or pos + 2 + size > len(sig):
+            return None
+        values.append(int.from_bytes(sig[pos + 2:pos + 2 + size], 'big'))
+        pos += 2 + size
+    if pos != len(sig):
+        return None
+    return tuple(values)
+
+def _rfc6979_nonces(secret, hash):
+    """Generate RFC6979 (HMAC-SHA256) nonces for signing hash with secret"""
+    x = secret.to_bytes(32, 'big')
+    h1 = (int.from_bytes(hash, 'big') % SECP256K1_ORDER).to_bytes(32, 'big')
+    v = b'\x01' * 32
+    k = b'\x00' * 32
+    k = hmac.new(k, v + b'\x00' + x + h1, hashlib.sha256).digest()
+    v = hmac.new(k, v, hashlib.sha256).digest()
+    k = hmac.new(k, v + b'\x01' + x + h1, hashlib.sha256).digest()
+    v = hmac.new(k, v, hashlib.sha256).digest()
+    while True:
+        v = hmac.new(k, v, hashlib.sha256).digest()
+        nonce = int.from_bytes(v, 'big')
+        if 1 <= nonce < SECP256K1_ORDER:
+            yield nonce
+        k = hmac.new(k, v + b'\x00', hashlib.sha256).digest()
+        v = hmac.new(k, v, hashlib.sha256).digest()
+
+class PythonECKey(object):
+    """Pure-Python secp256k1 key with the same interface as OpenSSLECKey
+
+    Signatures use RFC6979 deterministic nonces, so signing the same hash
+    with the same key always yields the same signature.
+    """
+
+    def __init__(self):
+        self.secret = None
+        self.pubkey = None
+        self.compressed = False
+
+    def set_secretbytes(self, secret):
+        # Like BN_bin2bn(secret, 32) the bytes are read big-endian from the
+        # start of a 32 byte buffer; shorter secrets are zero padded.
+        secret = int.from_bytes(secret[:32].ljust(32, b'\x00'), 'big')
+        if not 0 < secret < SECP256K1_ORDER:
+            raise ValueError("Could not derive public key from the supplied secret.")
+        self.secret = secret
+        self.pubkey = _mul_g(secret)
+        return self
+
+    def set_privkey(self, key):
+        # Minimal SEC1 ECPrivateKey parser: locate the 32 byte private key
+        # OCTET STRING that follows the version INTEGER.
+        pos = key.find(b'\x02\x01\x01\x04\x20')
+        if pos < 0 or pos + 37 > len(key):
+            return 0
+        try:
+            self.set_secretbytes(key[pos + 5:pos + 37])
+        except ValueError:
+            return 0
+        return 1
+
+    def set_pubkey(self, key):
+        point = _decode_point(bytes(key))
+        if point is None:
+            return 0
+        self.pubkey = point
+        self.compressed = len(key) == 33
+        return 1
+
+    def get_privkey(self):
+        pubkey = _encode_point(self.pubkey, self.compressed)
+        body = (b'\x02\x01\x01\x04\x20' + self.secret.to_bytes(32, 'big') +
+                b'\xa0\x07\x06\x05\x2b\x81\x04\x00\x0a' +
+                b'\xa1' + bytes([len(pubkey) + 3]) + b'\x03' + bytes([len(pubkey) + 1]) + b'\x00' + pubkey)
+        return b'\x30' + bytes([len(body)]) + body
+
+    def get_pubkey(self):
+        if self.pubkey is None:
+            return b''
+        return _encode_point(self.pubkey, self.compressed)
+
+    def get_raw_ecdh_key(self, other_pubkey):
+        point = _mul(other_pubkey.pubkey, self.secret)
+        if point is None:
+            raise Exception('CKey.get_ecdh_key(): ECDH_compute_key() failed')
+        return point[0].to_bytes(32, 'big')
+
+    def get_ecdh_key(self, other_pubkey, kdf=lambda k: hashlib.sha256(k).digest()):
+        # FIXME: be warned it's not clear what the kdf should be as a default
+        r = self.get_raw_ecdh_key(other_pubkey)
+        return kdf(r)
+
+    def sign(self, hash, low_s = True):
+        if not isinstance(hash, bytes):
+            raise TypeError('Hash must be bytes instance; got %r' % hash.__class__)
+        if len(hash) != 32:
+            raise ValueError('Hash must be exactly 32 bytes long')
+
+        z = int.from_bytes(hash, 'big')
+        for nonce in _rfc6979_nonces(self.secret, hash):
+            r = _mul_g(nonce)[0] % SECP256K1_ORDER
+            if r == 0:
+                continue
+            s = _modinv(nonce, SECP256K1_ORDER) * (z + r * self.secret) % SECP256K1_ORDER
+            if s != 0:
+                break
+        if low_s and s > SECP256K1_ORDER_HALF:
+            s = SECP256K1_ORDER - s
+        body = _der_encode_int(r) + _der_encode_int(s)
+        return b'\x30' + bytes([len(body)]) + body
+
+    def verify(self, hash, sig):
+        """Verify a DER signature"""
+        if self.pubkey is None:
+            return False
+        rs = _der_decode_sig(bytes(sig))
+        if rs is None:
+            return False
+        r, s = rs
+        if not (0 < r < SECP256K1_ORDER and 0 < s < SECP256K1_ORDER):
+            return False
+        w = _modinv(s, SECP256K1_ORDER)
+        z = int.from_bytes(hash, 'big') % SECP256K1_ORDER
+        point = _affine_add(_mul_g(z * w % SECP256K1_ORDER), _mul(self.pubkey, r * w % SECP256K1_ORDER))
+        return point is not None and point[0] % SECP256K1_ORDER == r
+
+    def set_compressed(self, compressed):
+        self.compressed = bool(compressed)
+
+
+if ssl is not None:
+    CECKey = OpenSSLECKey
+else:
+    CECKey = PythonECKey
+
+
 class CPubKey(bytes):
     """An encapsulated public key
 
@@ -234,3 +537,32 @@ class CPubKey(bytes):
         else:
             return '%s(b%s)' % (self.__class__.__name__, super(CPubKey, self).__repr__())
 
+
+class TestFrameworkKey(unittest.TestCase):
+    def test_rfc6979(self):
+        """Deterministic signing test vector (secret 1, sha256("Satoshi Nakamoto"))."""
+        key = PythonECKey()
+        key.set_secretbytes((1).to_bytes(32, 'big'))
+        msg_hash = hashlib.sha256(b"Satoshi Nakamoto").digest()
+        sig = key.sign(msg_hash)
+        self.assertEqual(sig.hex(),
+            "3045022100934b1ea10a4b3c1757e2b0c017d0b6143ce3c9a7e6a4a49860d7a6ab210ee3d8"
+            "02202442ce9d2b916064108014783e923ec36b49743e2ffa1c4496f01a512aafd9e5")
+        self.assertTrue(key.verify(msg_hash, sig))
+        self.assertFalse(key.verify(hashlib.sha256(b"Satoshi").digest(), sig))
+
+    @unittest.skipIf(ssl is None, "OpenSSL backend not available")
+    def test_backends_agree(self):
+        """Both backends derive the same keys and accept each other's signatures."""
+        for i in range(1, 17):
+            secret = hashlib.sha256(bytes([i])).digest()
+            msg_hash = hashlib.sha256(secret).digest()
+            ossl_key, py_key = OpenSSLECKey(), PythonECKey()
+            ossl_key.set_secretbytes(secret)
+            py_key.set_secretbytes(secret)
+            for compressed in (True, False):
+                ossl_key.set_compressed(compressed)
+                py_key.set_compressed(compressed)
+                self.assertEqual(ossl_key.get_pubkey(), py_key.get_pubkey())
+            self.assertTrue(ossl_key.verify(msg_hash, py_key.sign(msg_hash)))
+            self.assertTrue(py_key.verify(msg_hash, ossl_key.sign(msg_hash)))
@@ -29,7 +29,7 @@ import asyncore
 import time
 import sys
 import random
-from .util import hex_str_to_bytes, bytes_to_hex_str
+from binascii import hexlify, unhexlify
 from io import BytesIO
 from codecs import encode
 import hashlib
@@ -37,8 +37,11 @@ from threading import RLock
 from threading import Thread
 import logging
 import copy
+import functools
+import unittest
+import unittest.mock
 import ltc_scrypt
-from test_framework.siphash import siphash256
+from test_framework.siphash import siphash256, siphash256_batch
 
 BIP0031_VERSION = 60000
 MY_VERSION = 70014  # past bip-31 for ping/pong
@@ -149,13 +152,15 @@ def deser_vector(f, c):
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
+    # Joined at the end: appending to bytes copies them, which is
+    # quadratic for vectors of large objects such as a block's txs
+    r = [ser_compact_size(len(l))]
     for i in l:
         if ser_function_name:
-            r += getattr(i, ser_function_name)()
+            r.append(getattr(i, ser_function_name)())
         else:
-            r += i.serialize()
-    return r
+            r.append(i.serialize())
+    return b"".join(r)
 
 
 def deser_uint256_vector(f):
@@ -207,12 +212,12 @@ def ser_int_vector(l):
 
 # Deserialize from a hex string representation (eg from RPC)
 def FromHex(obj, hex_string):
-    obj.deserialize(BytesIO(hex_str_to_bytes(hex_string)))
+    obj.deserialize(BytesIO(unhexlify(hex_string.encode('ascii'))))
     return obj
 
 # Convert a binary-serializable object to hex (eg for submission via RPC)
 def ToHex(obj):
-    return bytes_to_hex_str(obj.serialize())
+    return hexlify(obj.serialize()).decode('ascii')
 
 # Objects that map to dogecoind objects, which can be serialized/deserialized
 
@@ -341,7 +346,7 @@ class CTxIn(object):
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" \
-            % (repr(self.prevout), bytes_to_hex_str(self.scriptSig),
+            % (repr(self.prevout), hexlify(self.scriptSig).decode('ascii'),
                self.nSequence)
 
 
@@ -363,7 +368,7 @@ class CTxOut(object):
     def __repr__(self):
         return "CTxOut(nValue=%i.%08i scriptPubKey=%s)" \
             % (self.nValue // COIN, self.nValue % COIN,
-               bytes_to_hex_str(self.scriptPubKey))
+               hexlify(self.scriptPubKey).decode('ascii'))
 
 
 class CScriptWitness(object):
@@ -373,7 +378,7 @@ class CScriptWitness(object):
 
     def __repr__(self):
         return "CScriptWitness(%s)" % \
-               (",".join([bytes_to_hex_str(x) for x in self.stack]))
+               (",".join([hexlify(x).decode('ascii') for x in self.stack]))
 
     def is_null(self):
         if self.stack:
@@ -529,6 +534,44 @@ class CTransaction(object):
             % (self.nVersion, repr(self.vin), repr(self.vout), repr(self.wit), self.nLockTime)
 
 
+# Script of an OP_RETURN output pushing 512 bytes, 527 bytes serialized
+# with a zero value.  Big transactions for filling blocks and mempools
+# carry many of these outputs; they share the (immutable) script, but each
+# gets its own CTxOut, so changing one output changes no other.
+FILLER_SCRIPT = b"\x6a\x4d" + struct.pack("<H", 512) + b"\x01" * 512
+
+def filler_txouts(count):
+    """Return a list of count new filler outputs"""
+    return [CTxOut(0, FILLER_SCRIPT) for _ in range(count)]
+
+@functools.lru_cache(maxsize=16)
+def filler_script(length):
+    """
+    Return a script of OP_RETURN followed by length - 1 OP_NOPs.  Cached,
+    as big scripts are slow to build opcode by opcode with CScript.
+    """
+    return b"\x6a" + b"\x61" * (length - 1)
+
+def pad_tx(tx, size):
+    """
+    Append one zero-value filler output to tx so that it serializes to
+    exactly size bytes, and return tx.  Sizes in the gap where the length
+    prefix of the script grows (2 bytes too many for a one-byte prefix,
+    too few for a three-byte one) can't be hit, and raise ValueError, as
+    does a tx already within 10 bytes of size.
+    """
+    remaining = size - len(tx.serialize())
+    # The output count may grow by a byte too
+    remaining -= len(ser_compact_size(len(tx.vout) + 1)) - len(ser_compact_size(len(tx.vout)))
+    for prefix_size in (1, 3, 5):
+        length = remaining - 8 - prefix_size
+        if length > 0 and len(ser_compact_size(length)) == prefix_size:
+            tx.vout.append(CTxOut(0, filler_script(length)))
+            tx.sha256 = None
+            return tx
+    raise ValueError("Can't pad a %d byte transaction to %d bytes" % (size - remaining, size))
+
+
 class CBlockHeader(object):
     def __init__(self, header=None):
         if header is None:
@@ -824,6 +867,10 @@ def calculate_shortid(k0, k1, tx_hash):
     expected_shortid &= 0x0000ffffffffffff
     return expected_shortid
 
+# Calculate the shortids for a list of transaction hashes in one batch
+def calculate_shortids(k0, k1, tx_hashes):
+    return [h & 0x0000ffffffffffff for h in siphash256_batch(k0, k1, tx_hashes)]
+
 # This version gets rid of the array lengths, and reinterprets the differential
 # encoding into indices that can be used for lookup.
 class HeaderAndShortIDs(object):
@@ -873,15 +920,17 @@ class HeaderAndShortIDs(object):
         self.header = CBlockHeader(block)
         self.nonce = nonce
         self.prefilled_txn = [ PrefilledTransaction(i, block.vtx[i]) for i in prefill_list ]
-        self.shortids = []
         self.use_witness = use_witness
         [k0, k1] = self.get_siphash_keys()
+        prefilled = set(prefill_list)
+        tx_hashes = []
         for i in range(len(block.vtx)):
-            if i not in prefill_list:
+            if i not in prefilled:
                 tx_hash = block.vtx[i].sha256
                 if use_witness:
                     tx_hash = block.vtx[i].calc_sha256(with_witness=True)
-                self.shortids.append(calculate_shortid(k0, k1, tx_hash))
+                tx_hashes.append(tx_hash)
+        self.shortids = calculate_shortids(k0, k1, tx_hashes)
 
     def __repr__(self):
         return "HeaderAndShortIDs(header=%s, nonce=%d, shortids=%s, prefilledtxn=%s" % (repr(self.header), self.nonce, repr(self.shortids), repr(self.prefilled_txn))
@@ -950,6 +999,84 @@ class BlockTransactions(object):
         return "BlockTransactions(hash=%064x transactions=%s)" % (self.blockhash, repr(self.transactions))
 
 
+# Python-side counterpart of dogecoind's PartiallyDownloadedBlock: fills in a
+# compact block from a dict of known transactions (e.g. txid -> CTransaction),
+# works out the getblocktxn request for what is missing and completes the
+# block from the blocktxn response.
+class PartiallyDownloadedBlock(object):
+    def __init__(self, header_and_shortids, mempool, use_witness=False):
+        if isinstance(header_and_shortids, P2PHeaderAndShortIDs):
+            header_and_shortids = HeaderAndShortIDs(header_and_shortids)
+        self.header = CBlockHeader(header_and_shortids.header)
+        self.header.calc_sha256()
+        self.use_witness = use_witness
+        num_txs = len(header_and_shortids.prefilled_txn) + len(header_and_shortids.shortids)
+        self.txn_available = [None] * num_txs
+        for x in header_and_shortids.prefilled_txn:
+            self.txn_available[x.index] = x.tx
+
+        # Map each shortid to the block index it stands for. Duplicate
+        # shortids make the compact block unusable, as they do in dogecoind.
+        self.shortid_index = {}
+        free_indexes = [i for i in range(num_txs) if self.txn_available[i] is None]
+        for index, shortid in zip(free_indexes, header_and_shortids.shortids):
+            if shortid in self.shortid_index:
+                raise ValueError("Duplicate shortid %012x in compact block" % shortid)
+            self.shortid_index[shortid] = index
+
+        # Match the mempool against the shortids. If two transactions map to
+        # the same shortid the slot is cleared and requested from the peer.
+        self.mempool_collisions = 0
+        collided = set()
+        txs = list(mempool.values())
+        hashes = []
+        for tx in txs:
+            if use_witness:
+                hashes.append(tx.calc_sha256(with_witness=True))
+            else:
+                if tx.sha256 is None:
+                    tx.calc_sha256()
+                hashes.append(tx.sha256)
+        [k0, k1] = header_and_shortids.get_siphash_keys()
+        for tx, shortid in zip(txs, calculate_shortids(k0, k1, hashes)):
+            index = self.shortid_index.get(shortid)
+            if index is None or index in collided:
+                continue
+            if self.txn_available[index] is not None:
+                self.txn_available[index] = None
+                collided.add(index)
+                self.mempool_collisions += 1
+            else:
+                self.txn_available[index] = tx
+
+    def is_tx_available(self, index):
+        return self.txn_available[index] is not None
+
+    def get_missing_indexes(self):
+        return [i for i, tx in enumerate(self.txn_available) if tx is None]
+
+    def get_block_txn_request(self):
+        request = BlockTransactionsRequest(self.header.sha256)
+        request.from_absolute(self.get_missing_indexes())
+        return request
+
+    # Returns the completed CBlock, or None if the merkle root doesn't match
+    # (e.g. after an undetected shortid collision), in which case the full
+    # block has to be requested instead.
+    def fill_block(self, block_transactions):
+        missing = self.get_missing_indexes()
+        if len(block_transactions.transactions) != len(missing):
+            raise ValueError("Expected %d transactions, got %d" % (len(missing), len(block_transactions.transactions)))
+        block = CBlock(self.header)
+        block.vtx = list(self.txn_available)
+        for index, tx in zip(missing, block_transactions.transactions):
+            block.vtx[index] = tx
+        if block.calc_merkle_root() != block.hashMerkleRoot:
+            return None
+        block.rehash()
+        return block
+
+
 # Objects that correspond to messages on the wire
 class msg_version(object):
     command = b"version"
@@ -1834,3 +1961,111 @@ class EarlyDisconnectError(Exception):
 
     def __str__(self):
         return repr(self.value)
+
+
+class TestFrameworkPartiallyDownloadedBlock(unittest.TestCase):
+    def create_block(self, num_txs):
+        block = CBlock()
+        block.nVersion = 0x620004
+        block.nTime = 1400000000
+        block.nBits = 0x207fffff
+        for i in range(num_txs):
+            tx = CTransaction()
+            tx.vin = [CTxIn(COutPoint(i, 0), b"", 0xffffffff)]
+            tx.vout = [CTxOut(i * COIN, b"\x51")]
+            tx.rehash()
+            block.vtx.append(tx)
+        block.hashMerkleRoot = block.calc_merkle_root()
+        block.rehash()
+        return block
+
+    def compact_block(self, block, prefill_list=(0,)):
+        """Round-trip through the differentially encoded P2P form"""
+        cmpct = HeaderAndShortIDs()
+        cmpct.initialize_from_block(block, nonce=7, prefill_list=prefill_list)
+        return cmpct.to_p2p()
+
+    def test_reconstruct(self):
+        """A compact block whose transactions are all known needs no request."""
+        block = self.create_block(6)
+        mempool = {tx.sha256: tx for tx in block.vtx[1:]}
+        partial = PartiallyDownloadedBlock(self.compact_block(block, [0, 3]), mempool)
+        self.assertEqual(partial.get_missing_indexes(), [])
+        self.assertEqual(partial.mempool_collisions, 0)
+        filled = partial.fill_block(BlockTransactions(block.sha256, []))
+        self.assertEqual(filled.sha256, block.sha256)
+        self.assertEqual([tx.sha256 for tx in filled.vtx], [tx.sha256 for tx in block.vtx])
+
+    def test_missing_transactions(self):
+        """Missing transactions are requested and filled in from blocktxn."""
+        block = self.create_block(6)
+        mempool = {tx.sha256: tx for tx in (block.vtx[1], block.vtx[3])}
+        partial = PartiallyDownloadedBlock(self.compact_block(block), mempool)
+        self.assertEqual(partial.get_missing_indexes(), [2, 4, 5])
+        self.assertTrue(partial.is_tx_available(3))
+        request = partial.get_block_txn_request()
+        self.assertEqual(request.blockhash, block.sha256)
+        self.assertEqual(request.to_absolute(), [2, 4, 5])
+        self.assertRaises(ValueError, partial.fill_block, BlockTransactions(block.sha256, block.vtx[4:]))
+        # The wrong transactions don't match the merkle root
+        self.assertIsNone(partial.fill_block(BlockTransactions(block.sha256, block.vtx[3:])))
+        filled = partial.fill_block(BlockTransactions(block.sha256, [block.vtx[2], block.vtx[4], block.vtx[5]]))
+        self.assertEqual(filled.sha256, block.sha256)
+
+    def test_shortid_collision(self):
+        """Colliding shortids are requested, or make the block unusable."""
+        block = self.create_block(4)
+        other = self.create_block(6).vtx[5]
+        # Give the other transaction the shortid of block.vtx[2]
+        shortids = {tx.sha256: i for (i, tx) in enumerate(block.vtx)}
+        shortids[other.sha256] = 2
+        fake_shortids = lambda k0, k1, hashes: [shortids[h] for h in hashes]
+        with unittest.mock.patch(__name__ + ".calculate_shortids", fake_shortids):
+            cmpct = self.compact_block(block)
+            # Two mempool transactions for one shortid: neither is used
+            mempool = {tx.sha256: tx for tx in block.vtx[1:] + [other]}
+            partial = PartiallyDownloadedBlock(cmpct, mempool)
+            self.assertEqual(partial.mempool_collisions, 1)
+            self.assertEqual(partial.get_missing_indexes(), [2])
+            filled = partial.fill_block(BlockTransactions(block.sha256, [block.vtx[2]]))
+            self.assertEqual(filled.sha256, block.sha256)
+            # An undetected collision only shows in the merkle root
+            mempool = {tx.sha256: tx for tx in (block.vtx[1], other, block.vtx[3])}
+            partial = PartiallyDownloadedBlock(cmpct, mempool)
+            self.assertEqual(partial.get_missing_indexes(), [])
+            self.assertIsNone(partial.fill_block(BlockTransactions(block.sha256, [])))
+            # Duplicate shortids within the compact block
+            cmpct.shortids[1] = cmpct.shortids[0]
+            self.assertRaises(ValueError, PartiallyDownloadedBlock, cmpct, mempool)
+
+
+class TestFrameworkFillerOutputs(unittest.TestCase):
+    def create_transaction(self):
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(1, 0), b"", 0xffffffff)]
+        tx.vout = [CTxOut(COIN, b"\x51")]
+        return tx
+
+    def test_filler_txouts(self):
+        """Filler outputs push 512 bytes after OP_RETURN and are not shared."""
+        txouts = filler_txouts(2)
+        self.assertEqual(len(txouts[0].serialize()), 527)
+        self.assertEqual(txouts[0].serialize()[8:13], bytes.fromhex("fd04026a4d"))
+        self.assertEqual(txouts[0].scriptPubKey[2:4], struct.pack("<H", 512))
+        txouts[0].nValue = 1
+        self.assertEqual([txout.nValue for txout in txouts + filler_txouts(1)], [1, 0, 0])
+
+    def test_pad_tx(self):
+        """pad_tx hits every size outside the script length prefix gap."""
+        base_size = len(self.create_transaction().serialize())
+        for padding in list(range(0, 600)) + [65800, 950000]:
+            tx = self.create_transaction()
+            if padding in (9 + 253, 9 + 254) or padding < 10:
+                self.assertRaises(ValueError, pad_tx, tx, base_size + padding)
+            else:
+                self.assertEqual(len(pad_tx(tx, base_size + padding).serialize()), base_size + padding)
+        # Filling up the output count prefix
+        tx = self.create_transaction()
+        tx.vout += filler_txouts(251)
+        self.assertEqual(len(pad_tx(tx, 200000).serialize()), 200000)
+        self.assertEqual(len(tx.vout), 253)
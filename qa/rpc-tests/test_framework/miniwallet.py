@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# Copyright (c) 2023 The Dogecoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Wallet-free transaction generation.
+
+MiniWallet tracks the outputs paying to one deterministic P2PKH key and
+builds and signs spends of them in Python, so tests can create thousands
+of transactions without the listunspent / createrawtransaction /
+signrawtransaction / sendrawtransaction round-trips of the node wallet,
+and submit them in JSON-RPC batches:
+
+    wallet = MiniWallet(node)
+    wallet.fund(1000 * COIN, num_outputs=100)   # or wallet.generate(n)
+    node.generate(1)
+    txs = [wallet.create_transaction(fee_rate=rate) for rate in rates]
+    wallet.send(txs)
+
+All amounts are in koinu and fee rates in koinu per 1000 bytes, as in
+mininode.
+
+Signing dominates the cost of building a transaction (about 1ms with
+either key backend), so a MiniWallet created with signed=False pays to
+P2SH(OP_TRUE) instead, whose spends need no signature, for tests that
+just need many standard transactions.
+
+"""
+import collections
+import hashlib
+import unittest
+
+from .address import key_to_p2pkh, script_to_p2sh
+from .key import CECKey
+from .mininode import COIN, COutPoint, CTransaction, CTxIn, CTxOut, FromHex, ToHex
+from .script import (
+    CScript,
+    OP_CHECKSIG,
+    OP_DUP,
+    OP_EQUALVERIFY,
+    OP_EQUAL,
+    OP_HASH160,
+    OP_TRUE,
+    SIGHASH_ALL,
+    SignatureHash,
+    hash160,
+)
+
+# Dogecoin's recommended minimum fee rate (RECOMMENDED_MIN_TX_FEE per kB)
+DEFAULT_FEE_RATE = COIN // 100
+
+# Outputs below this are dust and need extra fee to be relayed
+DUST_LIMIT = COIN // 100
+
+# Upper bound of the size a P2PKH signature and public key add to an input
+P2PKH_SCRIPTSIG_SIZE = 1 + 73 + 1 + 33
+
+# Unsigned outputs pay to P2SH(OP_TRUE), spent by pushing the redeem script
+OP_TRUE_REDEEM_SCRIPT = CScript([OP_TRUE])
+OP_TRUE_SCRIPTSIG = CScript([bytes(OP_TRUE_REDEEM_SCRIPT)])
+
+# Transactions per sendrawtransaction batch
+SEND_BATCH_SIZE = 1000
+
+UTXO = collections.namedtuple('UTXO', ['txid', 'vout', 'value'])
+
+
+class MiniWallet(object):
+    def __init__(self, node, seed=0, signed=True):
+        """
+        node is the RPC connection used to fund the wallet and send its
+        transactions.  Wallets with the same seed share the same key; with
+        signed=False, all of them share the P2SH(OP_TRUE) address.
+        """
+        self.node = node
+        self.signed = signed
+        self.key = CECKey()
+        self.key.set_secretbytes(hashlib.sha256(b"MiniWallet %d" % seed).digest())
+        self.key.set_compressed(True)
+        self.pubkey = self.key.get_pubkey()
+        if signed:
+            self.script_pubkey = CScript([OP_DUP, OP_HASH160, hash160(self.pubkey), OP_EQUALVERIFY, OP_CHECKSIG])
+            self.address = key_to_p2pkh(self.pubkey)
+        else:
+            self.script_pubkey = CScript([OP_HASH160, hash160(OP_TRUE_REDEEM_SCRIPT), OP_EQUAL])
+            self.address = script_to_p2sh(OP_TRUE_REDEEM_SCRIPT)
+        # Spendable outputs, oldest first; outputs of transactions created
+        # by the wallet are added as soon as they are created
+        self.utxos = collections.deque()
+
+    def get_balance(self):
+        return sum(utxo.value for utxo in self.utxos)
+
+    def get_utxo(self):
+        """Remove and return the oldest output"""
+        if not self.utxos:
+            raise RuntimeError("MiniWallet has no outputs left")
+        return self.utxos.popleft()
+
+    def scan_tx(self, tx):
+        """Add the outputs of the CTransaction tx that pay to this wallet"""
+        tx.calc_sha256()
+        for (n, txout) in enumerate(tx.vout):
+            if txout.scriptPubKey == self.script_pubkey:
+                self.utxos.append(UTXO(tx.hash, n, txout.nValue))
+
+    def generate(self, num_blocks):
+        """
+        Mine num_blocks with their coinbases paying to this wallet, and
+        return the block hashes.  The coinbase outputs are tracked right
+        away but, like any coinbase, can only be spent once they mature.
+        """
+        hashes = self.node.generatetoaddress(num_blocks, self.address)
+        with self.node.batch() as b:
+            blocks = [b.getblock(h) for h in hashes]
+        with self.node.batch() as b:
+            coinbases = [(block.result()['tx'][0], b.gettxout(block.result()['tx'][0], 0)) for block in blocks]
+        for (txid, txout) in coinbases:
+            self.utxos.append(UTXO(txid, 0, int(txout.result()['value'] * COIN)))
+        return hashes
+
+    def fund(self, amount, num_outputs=1):
+        """
+        Pay amount from the node's wallet to this wallet, split into
+        num_outputs equal outputs, and return the txid.
+        """
+        tx = CTransaction()
+        tx.vout = [CTxOut(amount // num_outputs, self.script_pubkey) for _ in range(num_outputs)]
+        funded = self.node.fundrawtransaction(ToHex(tx))
+        signed = self.node.signrawtransaction(funded['hex'])
+        txid = self.node.sendrawtransaction(signed['hex'])
+        self.scan_tx(FromHex(CTransaction(), signed['hex']))
+        return txid
+
+    def sign_tx(self, tx):
+        """Sign all inputs of tx, which must spend outputs of this wallet"""
+        for (i, txin) in enumerate(tx.vin):
+            if self.signed:
+                (sighash, err) = SignatureHash(self.script_pubkey, tx, i, SIGHASH_ALL)
+                txin.scriptSig = CScript([self.key.sign(sighash) + bytes([SIGHASH_ALL]), self.pubkey])
+            else:
+                txin.scriptSig = OP_TRUE_SCRIPTSIG
+        tx.rehash()
+
+    def create_transaction(self, utxos=None, txouts=(), num_outputs=1, fee_rate=DEFAULT_FEE_RATE):
+        """
+        Build and sign a transaction spending utxos (by default the oldest
+        output) to txouts, followed by num_outputs equal outputs back to
+        this wallet with the rest of the value minus a fee of fee_rate.
+        The new outputs of the wallet are tracked right away.  Returns the
+        CTransaction, which is not sent.
+        """
+        default_utxo = utxos is None
+        if default_utxo:
+            utxos = [self.get_utxo()]
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(int(utxo.txid, 16), utxo.vout)) for utxo in utxos]
+        tx.vout = list(txouts) + [CTxOut(0, self.script_pubkey) for _ in range(num_outputs)]
+        scriptsig_size = P2PKH_SCRIPTSIG_SIZE if self.signed else len(OP_TRUE_SCRIPTSIG)
+        size = len(tx.serialize()) + scriptsig_size * len(tx.vin)
+        fee = -(-size * fee_rate // 1000)
+        change = sum(utxo.value for utxo in utxos) - sum(txout.nValue for txout in txouts) - fee
+        if change < num_outputs * DUST_LIMIT:
+            if default_utxo:
+                self.utxos.appendleft(utxos[0])
+            raise RuntimeError("Insufficient funds: %d koinu left for %d outputs" % (change, num_outputs))
+        for txout in tx.vout[len(txouts):]:
+            txout.nValue = change // num_outputs
+        tx.vout[-1].nValue += change % num_outputs
+        self.sign_tx(tx)
+        self.scan_tx(tx)
+        return tx
+
+    def send(self, txs):
+        """
+        Send the CTransactions txs (parents before children) in batches of
+        SEND_BATCH_SIZE, and return their txids.
+        """
+        txids = []
+        for start in range(0, len(txs), SEND_BATCH_SIZE):
+            with self.node.batch() as b:
+                sent = [b.sendrawtransaction(ToHex(tx), True) for tx in txs[start:start + SEND_BATCH_SIZE]]
+            txids += [txid.result() for txid in sent]
+        return txids
+
+
+class TestFrameworkMiniWallet(unittest.TestCase):
+    def test_create_transaction(self):
+        """Transactions chain, pay the fee rate and carry valid signatures."""
+        wallet = MiniWallet(None)
+        self.assertEqual(wallet.address, MiniWallet(None).address)
+        self.assertNotEqual(wallet.address, MiniWallet(None, seed=1).address)
+        wallet.utxos.append(UTXO("11" * 32, 0, 10 * COIN))
+        parent = wallet.create_transaction(num_outputs=3, fee_rate=DEFAULT_FEE_RATE)
+        self.assertEqual(len(wallet.utxos), 3)
+        self.assertEqual([utxo.txid for utxo in wallet.utxos], [parent.hash] * 3)
+        child = wallet.create_transaction(utxos=[wallet.get_utxo(), wallet.get_utxo()], fee_rate=10 * DEFAULT_FEE_RATE)
+        for (tx, value_in, fee_rate) in ((parent, 10 * COIN, DEFAULT_FEE_RATE),
+                                         (child, sum(out.nValue for out in parent.vout[:2]), 10 * DEFAULT_FEE_RATE)):
+            fee = value_in - sum(out.nValue for out in tx.vout)
+            size = len(tx.serialize())
+            self.assertTrue(size * fee_rate / 1000 <= fee <= (size + 2 * len(tx.vin)) * fee_rate / 1000)
+            for (i, txin) in enumerate(tx.vin):
+                (sighash, err) = SignatureHash(wallet.script_pubkey, tx, i, SIGHASH_ALL)
+                sig = list(CScript(txin.scriptSig))[0]
+                self.assertTrue(wallet.key.verify(sighash, sig[:-1]))
+        self.assertEqual(wallet.get_balance(), parent.vout[2].nValue + child.vout[0].nValue)
+        self.assertRaises(RuntimeError, wallet.create_transaction, txouts=[CTxOut(wallet.get_balance(), wallet.script_pubkey)])
+        self.assertEqual(len(wallet.utxos), 2)
+
+    def test_unsigned(self):
+        """Unsigned wallets pay to P2SH(OP_TRUE) and estimate the fee exactly."""
+        wallet = MiniWallet(None, signed=False)
+        self.assertEqual(wallet.address, "2ND8PB9RrfCaAcjfjP1Y6nAgFd9zWHYX4DN")
+        wallet.utxos.append(UTXO("11" * 32, 0, 10 * COIN))
+        tx = wallet.create_transaction(fee_rate=1000)
+        self.assertEqual(tx.vin[0].scriptSig, OP_TRUE_SCRIPTSIG)
+        self.assertEqual(10 * COIN - tx.vout[0].nValue, len(tx.serialize()))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# Copyright (c) 2023 The Dogecoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Profiling of test scripts, to tell whether a slow test spends its time in
+Python (building blocks, signing, serializing) or waiting on dogecoind.
+
+run_profiled() runs a function under cProfile, which counts the CPU time
+of every Python function (time blocked on RPC shows up under the socket
+methods), and optionally under SamplingProfiler, which records the
+wall-clock call stacks of the calling thread in the "collapsed" format
+read by flamegraph.pl and speedscope.
+
+"""
+import collections
+import cProfile
+import os
+import sys
+import threading
+
+
+class SamplingProfiler(object):
+    """
+    Sample the call stack of one thread every interval seconds from a
+    background thread, and count each distinct stack.
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, filename):
+        """Write one "<frame>;<frame>;... <samples>" line per stack"""
+        with open(filename, 'w', encoding='utf8') as f:
+            for (stack, count) in sorted(self.stacks.items()):
+                f.write("%s %d\n" % (stack, count))
+
+
+def run_profiled(func, basename, sample_interval=0):
+    """
+    Call func under cProfile and write the stats to basename + '.pstats'.
+    With a sample_interval (in seconds), also sample its stacks and write
+    them to basename + '.folded'.  The files are written even if func
+    raises.
+    """
+    profiler = cProfile.Profile()
+    sampler = SamplingProfiler(sample_interval) if sample_interval else None
+    if sampler:
+        sampler.start()
+    profiler.enable()
+    try:
+        return func()
+    finally:
+        profiler.disable()
+        profiler.dump_stats(basename + '.pstats')
+        if sampler:
+            sampler.stop()
+            sampler.write(basename + '.folded')
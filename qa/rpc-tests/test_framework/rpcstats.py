@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Copyright (c) 2023 The Dogecoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Per-node RPC latency statistics, recorded by AuthServiceProxyWrapper when
+enabled with util.enable_rpc_stats().
+
+Each RPC method called on each node gets a LatencyHistogram with the
+number of calls, the request and response body sizes, and the latencies
+in logarithmic buckets.  Each node also gets the total body sizes of all
+requests to it, batches included, reported by the RPC proxies through
+record_transfer(), so the counts survive proxies being replaced when a
+node restarts.  dump() writes them as JSON with p50/p90/p99 per method,
+and the buckets themselves so that files from several runs or builds can
+be merged and compared.
+
+"""
+import collections
+import json
+import math
+import threading
+
+# Buckets per doubling of latency: each bucket is about 9% wide, which
+# bounds the error of the reported percentiles
+BUCKETS_PER_DOUBLING = 8
+
+PERCENTILES = (50, 90, 99)
+
+
+class LatencyHistogram(object):
+    """
+    Histogram of call latencies.  Bucket b holds latencies of up to
+    2**(b / BUCKETS_PER_DOUBLING) microseconds.
+    """
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def add(self, seconds):
+        micros = max(seconds * 1e6, 1)
+        self.buckets[math.ceil(math.log2(micros) * BUCKETS_PER_DOUBLING)] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def percentile(self, p):
+        """Upper bound in seconds of the bucket holding the p-th percentile"""
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= rank:
+                return min(2 ** (b / BUCKETS_PER_DOUBLING) / 1e6, self.max_seconds)
+        return self.max_seconds
+
+    def to_json(self):
+        result = {'count': self.count,
+                  'total_ms': round(self.seconds * 1000, 3),
+                  'max_ms': round(self.max_seconds * 1000, 3),
+                  'bytes_sent': self.bytes_sent,
+                  'bytes_received': self.bytes_received}
+        for p in PERCENTILES:
+            result['p%d_ms' % p] = round(self.percentile(p) * 1000, 3)
+        result['buckets'] = {str(b): n for (b, n) in sorted(self.buckets.items())}
+        return result
+
+
+# Per node number, the histogram of each RPC method, and the bytes sent
+# and received in all requests
+histograms = collections.defaultdict(lambda: collections.defaultdict(LatencyHistogram))
+transfers = collections.defaultdict(collections.Counter)
+histograms_lock = threading.Lock()
+
+
+def record(node_number, method, seconds):
+    with histograms_lock:
+        histograms[node_number][method].add(seconds)
+
+
+def record_transfer(node_number, method, bytes_sent, bytes_received):
+    """
+    Count the request and response body sizes of one HTTP request to
+    node_number, and of method unless it is None (for batches)
+    """
+    with histograms_lock:
+        transfers[node_number]['bytes_sent'] += bytes_sent
+        transfers[node_number]['bytes_received'] += bytes_received
+        if method is not None:
+            histogram = histograms[node_number][method]
+            histogram.bytes_sent += bytes_sent
+            histogram.bytes_received += bytes_received
+
+
+def dump(filename, test_name=None):
+    """Write the histograms of all nodes to filename as JSON"""
+    with histograms_lock:
+        nodes = {str(n): {'bytes_sent': transfers[n]['bytes_sent'],
+                          'bytes_received': transfers[n]['bytes_received'],
+                          'methods': {method: h.to_json() for (method, h) in sorted(histograms[n].items())}}
+                 for n in sorted(set(histograms) | set(transfers))}
+    with open(filename, 'w', encoding='utf8') as f:
+        json.dump({'test': test_name,
+                   'buckets_per_doubling': BUCKETS_PER_DOUBLING,
+                   'nodes': nodes}, f, indent=1)
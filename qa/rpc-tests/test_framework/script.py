@@ -18,7 +18,18 @@ Functionality to build scripts, as well as SignatureHash().
 
 from .mininode import CTransaction, CTxOut, sha256, hash256, uint256_from_str, ser_uint256, ser_string
 from binascii import hexlify
-from .ripemd160 import ripemd160
+from functools import lru_cache
+import hashlib
+from . import ripemd160 as _ripemd160_pure
+
+# Prefer OpenSSL's RIPEMD160 through hashlib; OpenSSL 3 only provides it
+# with the legacy provider, so fall back to the pure Python implementation.
+try:
+    hashlib.new('ripemd160')
+    def ripemd160(s):
+        return hashlib.new('ripemd160', s).digest()
+except ValueError:
+    ripemd160 = _ripemd160_pure.ripemd160
 
 import sys
 bchr = chr
@@ -38,7 +49,17 @@ MAX_SCRIPT_OPCODES = 201
 
 OPCODE_NAMES = {}
 
+# Number of distinct keys/scripts whose hash160 is remembered
+HASH160_CACHE_SIZE = 1 << 16
+
+@lru_cache(maxsize=HASH160_CACHE_SIZE)
+def _hash160_cached(s):
+    return ripemd160(sha256(s))
+
 def hash160(s):
+    # Only immutable inputs can be memoized
+    if isinstance(s, bytes):
+        return _hash160_cached(s)
     return ripemd160(sha256(s))
 
 
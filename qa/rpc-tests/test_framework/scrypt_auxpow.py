@@ -16,66 +16,40 @@ from .auxpow import *
 import ltc_scrypt
 import binascii
 
-def computeAuxpowWithChainId (block, target, chainid, ok):
+# AuxpowBuilder instances by (chain id, processes)
+_builders = {}
+
+def getScryptAuxpowBuilder (chainid, processes=None):
   """
-  Build an auxpow object (serialised as hex string) that solves the
-  block, for a given chain id.
+  Return the (cached) AuxpowBuilder for scrypt parent blocks with the
+  given chain id (hex string).
   """
 
-  # Start by building the merge-mining coinbase.  The merkle tree
-  # consists only of the block hash as root.
-  coinbase = "fabe" + binascii.hexlify((b"m" * 2)).decode("ascii")
-  coinbase += block
-  coinbase += "01000000" + ("00" * 4)
-
-  # Construct "vector" of transaction inputs.
-  vin = "01"
-  vin += ("00" * 32) + ("ff" * 4)
-  vin += ("%02x" % int(len (coinbase) / 2)) + coinbase
-  vin += ("ff" * 4)
-
-  # Build up the full coinbase transaction.  It consists only
-  # of the input and has no outputs.
-  tx = "01000000" + vin + "00" + ("00" * 4)
-  txHash = doubleHashHex (tx)
-
-  # Construct the parent block header.  It need not be valid, just good
-  # enough for auxpow purposes.
-  header = "0100" + chainid + "00"
-  header += "00" * 32
-  header += reverseHex (txHash)
-  header += "00" * 4
-  header += "00" * 4
-  header += "00" * 4
-
-  # Mine the block.
-  (header, blockhash) = mineScryptBlock (header, target, ok)
-
-  # Build the MerkleTx part of the auxpow.
-  output = tx
-  output += blockhash
-  output += "00"
-  output += "00" * 4
+  key = (chainid, processes)
+  if key not in _builders:
+    # The parent block version is 0x00<chainid>0001 ("0100" + chainid + "00").
+    version = 1 | (int (chainid, 16) << 16)
+    _builders[key] = AuxpowBuilder (version, ltc_scrypt.getPoWHash, processes)
+  return _builders[key]
 
-  # Extend to full auxpow.
-  output += "00"
-  output += "00" * 4
-  output += header
+def computeAuxpowWithChainId (block, target, chainid, ok, processes=None):
+  """
+  Build an auxpow object (serialised as hex string) that solves the
+  block, for a given chain id.  With processes > 1 the parent header
+  is ground across a process pool.
+  """
 
-  return output
+  builder = getScryptAuxpowBuilder (chainid, processes)
+  auxpow = builder.build (binascii.unhexlify (block), int (target, 16), ok)
+  return binascii.hexlify (auxpow).decode ("ascii")
 
 # for now, just offer hashes to rpc until it matches the work we need
-def mineScryptAux (node, chainid, ok):
+def mineScryptAux (node, chainid, ok, processes=None):
   """
   Mine an auxpow block on the given RPC connection.
   """
 
-  auxblock = node.getauxblock ()
-  target = reverseHex (auxblock['target'])
-
-  apow = computeAuxpowWithChainId (auxblock['hash'], target, chainid, ok)
-  res = node.getauxblock (auxblock['hash'], apow)
-  return res
+  return getScryptAuxpowBuilder (chainid, processes).mine (node, ok)
 
 def mineScryptBlock (header, target, ok):
   """
@@ -83,18 +57,10 @@ def mineScryptBlock (header, target, ok):
   for the given target.
   """
 
-  data = bytearray (binascii.unhexlify(header))
-  while True:
-    assert data[79] < 255
-    data[79] += 1
-    hexData = binascii.hexlify(data).decode("ascii")
-
-    scrypt = getScryptPoW(hexData)
-    if (ok and scrypt < target) or ((not ok) and scrypt > target):
-      break
-
-  blockhash = doubleHashHex (hexData)
-  return (hexData, blockhash)
+  data = solveHeader (binascii.unhexlify (header), int (target, 16), ok,
+                      ltc_scrypt.getPoWHash)
+  hexData = binascii.hexlify (data).decode ("ascii")
+  return (hexData, doubleHashHex (hexData))
 
 def getScryptPoW(hexData):
   """
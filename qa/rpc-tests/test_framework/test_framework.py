@@ -23,10 +23,17 @@ from .util import (
     stop_nodes,
     stop_node,
     enable_coverage,
+    enable_rpc_stats,
     check_json_precision,
     initialize_chain_clean,
+    format_sync_time,
+    sync_calls,
+    load_warm_nodes,
+    release_warm_nodes,
     PortSeed,
 )
+from . import coverage, rpcstats
+from .profiling import run_profiled
 from .authproxy import JSONRPCException
 
 
@@ -101,6 +108,16 @@ class BitcoinTestFramework(object):
         stop_nodes(self.nodes)
         self.setup_network(False)
 
+    def test_name(self):
+        return os.path.splitext(os.path.basename(sys.argv[0]))[0]
+
+    def run_profiled_test(self):
+        profiledir = self.options.profiledir or self.options.root
+        os.makedirs(profiledir, exist_ok=True)
+        basename = os.path.join(profiledir, "%s.%d" % (self.test_name(), self.options.port_seed))
+        print("Writing profile to %s.pstats" % basename)
+        run_profiled(self.run_test, basename, self.options.sample_interval / 1000)
+
     def main(self):
 
         parser = optparse.OptionParser(usage="%prog [options]")
@@ -120,6 +137,17 @@ class BitcoinTestFramework(object):
                           help="The seed to use for assigning port numbers (default: current process id)")
         parser.add_option("--coveragedir", dest="coveragedir",
                           help="Write tested RPC commands into this directory")
+        parser.add_option("--rpcstatsdir", dest="rpcstatsdir",
+                          help="Write per-node RPC latency histograms as <test>.<portseed>.json into this directory")
+        parser.add_option("--warmpool", dest="warmpool", default=False, action="store_true",
+                          help="Use the dogecoinds that rpc-tests.py -warmpool started in tmpdir")
+        parser.add_option("--profile", dest="profile", default=False, action="store_true",
+                          help="Profile run_test with cProfile and write <test>.<portseed>.pstats into profiledir")
+        parser.add_option("--profiledir", dest="profiledir",
+                          help="Directory for profiles (default: tmpdir, which is kept)")
+        parser.add_option("--sampleinterval", dest="sample_interval", default=0, type='float',
+                          help="With --profile, also sample the stacks of run_test every SAMPLE_INTERVAL ms "
+                               "and write them to <test>.<portseed>.folded (default: off)")
         self.add_options(parser)
         (self.options, self.args) = parser.parse_args()
 
@@ -132,6 +160,9 @@ class BitcoinTestFramework(object):
         if self.options.coveragedir:
             enable_coverage(self.options.coveragedir)
 
+        if self.options.rpcstatsdir:
+            enable_rpc_stats()
+
         PortSeed.n = self.options.port_seed
 
         os.environ['PATH'] = self.options.srcdir+":"+self.options.srcdir+"/qt:"+os.environ['PATH']
@@ -140,10 +171,15 @@ class BitcoinTestFramework(object):
 
         success = False
         try:
-            os.makedirs(self.options.tmpdir, exist_ok=False)
+            os.makedirs(self.options.tmpdir, exist_ok=self.options.warmpool)
+            if self.options.warmpool:
+                load_warm_nodes(self.options.tmpdir)
             self.setup_chain()
             self.setup_network()
-            self.run_test()
+            if self.options.profile:
+                self.run_profiled_test()
+            else:
+                self.run_test()
             success = True
         except JSONRPCException as e:
             print("JSONRPC error: "+e.error['message'])
@@ -160,11 +196,26 @@ class BitcoinTestFramework(object):
         except KeyboardInterrupt as e:
             print("Exiting after " + repr(e))
 
-        if not self.options.noshutdown:
-            print("Stopping nodes")
-            stop_nodes(self.nodes)
-        else:
-            print("Note: dogecoinds were not stopped and may still be running")
+        if sync_calls and os.getenv("PYTHON_DEBUG", ""):
+            print("Time spent syncing: " + format_sync_time())
+
+        try:
+            release_warm_nodes()
+
+            if not self.options.noshutdown:
+                print("Stopping nodes")
+                stop_nodes(self.nodes)
+            else:
+                print("Note: dogecoinds were not stopped and may still be running")
+        finally:
+            # Keep the stats of a run whose nodes failed to stop
+            if self.options.coveragedir:
+                coverage.flush()
+
+            if self.options.rpcstatsdir:
+                os.makedirs(self.options.rpcstatsdir, exist_ok=True)
+                rpcstats.dump(os.path.join(self.options.rpcstatsdir, "%s.%d.json" % (self.test_name(), self.options.port_seed)),
+                              os.path.basename(sys.argv[0]))
 
         if not self.options.nocleanup and not self.options.noshutdown and success:
             print("Cleaning up")
@@ -9,11 +9,13 @@
 # Helpful routines for regression testing
 #
 
+import asyncio
 import math
 import os
 import sys
 
 from binascii import hexlify, unhexlify
+from io import BytesIO
 from base64 import b64encode
 from decimal import Decimal, ROUND_DOWN
 import json
@@ -24,11 +26,21 @@ import subprocess
 import time
 import re
 import errno
-
-from . import coverage
-from .authproxy import AuthServiceProxy, JSONRPCException
+import signal
+import functools
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import coverage, rpcstats
+from .asyncproxy import AsyncAuthServiceProxy
+from .authproxy import AuthServiceProxy, JSONRPCException, PooledAuthServiceProxy
 
 COVERAGE_DIR = None
+RPC_STATS = False
 
 # The maximum number of nodes a single test can spawn
 MAX_NODES = 8
@@ -39,6 +51,21 @@ PORT_RANGE = 5000
 
 DOGECOIND_PROC_WAIT_TIMEOUT = 60
 
+# ioctl request that makes a file share another file's extents
+# copy-on-write (a "reflink"), from linux/fs.h
+FICLONE = 0x40049409
+# LevelDB never modifies its table files once written, so they can be
+# hardlinked from the cache instead of copied
+IMMUTABLE_DATADIR_FILES = ('.ldb', '.sst')
+
+# Written by rpc-tests.py -warmpool into a test's tmpdir, describing the
+# dogecoinds it already started there on the cached chain
+WARM_NODES_FILE = "warm_nodes.json"
+
+# Written by rpc-tests.py -warmpool into the datadir of a dogecoind it
+# started once it exits (before reaping it), holding the exit status
+WARM_EXIT_FILE = "warm_exit_status"
+
 
 class PortSeed:
     # Must be initialized with a unique integer for each process
@@ -70,8 +97,13 @@ def enable_coverage(dirname):
     global COVERAGE_DIR
     COVERAGE_DIR = dirname
 
+def enable_rpc_stats():
+    """Record latency histograms of the RPC calls to each node (see rpcstats)."""
+    global RPC_STATS
+    RPC_STATS = True
+
 
-def get_rpc_proxy(url, node_number, timeout=None):
+def get_rpc_proxy(url, node_number, timeout=None, pooled=False):
     """
     Args:
         url (str): URL of the RPC server to call
@@ -79,6 +111,7 @@ def get_rpc_proxy(url, node_number, timeout=None):
 
     Kwargs:
         timeout (int): HTTP timeout in seconds
+        pooled (bool): use a thread-safe PooledAuthServiceProxy
 
     Returns:
         AuthServiceProxy. convenience object for making RPC calls.
@@ -87,14 +120,18 @@ def get_rpc_proxy(url, node_number, timeout=None):
     proxy_kwargs = {}
     if timeout is not None:
         proxy_kwargs['timeout'] = timeout
+    if RPC_STATS:
+        proxy_kwargs['on_transfer'] = functools.partial(rpcstats.record_transfer, node_number)
 
-    proxy = AuthServiceProxy(url, **proxy_kwargs)
+    proxy_class = PooledAuthServiceProxy if pooled else AuthServiceProxy
+    proxy = proxy_class(url, **proxy_kwargs)
     proxy.url = url  # store URL on proxy for info
 
     coverage_logfile = coverage.get_filename(
         COVERAGE_DIR, node_number) if COVERAGE_DIR else None
 
-    return coverage.AuthServiceProxyWrapper(proxy, coverage_logfile)
+    return coverage.AuthServiceProxyWrapper(proxy, coverage_logfile,
+                                            node_number if RPC_STATS else None)
 
 
 def p2p_port(n):
@@ -123,6 +160,51 @@ def hex_str_to_bytes(hex_str):
 def str_to_b64str(string):
     return b64encode(string.encode('utf-8')).decode('ascii')
 
+# Total seconds spent in, and number of calls to, each sync helper during
+# this test, printed by BitcoinTestFramework.main at the end of the test
+sync_time = Counter()
+sync_calls = Counter()
+
+def track_sync_time(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start_time = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sync_time[func.__name__] += time.time() - start_time
+            sync_calls[func.__name__] += 1
+    return wrapper
+
+def format_sync_time():
+    return ", ".join("%s: %d calls, %.2fs" % (name, sync_calls[name], sync_time[name])
+                     for name in sorted(sync_calls))
+
+def backoff_delays(max_delay, initial_delay=0.01):
+    """Yield exponentially growing poll intervals, capped at max_delay seconds"""
+    delay = initial_delay
+    while True:
+        yield min(delay, max_delay)
+        delay *= 2
+
+# Threads for map_nodes, kept for the whole test as the sync helpers call
+# it on every poll
+node_executor = None
+node_executor_workers = 0
+
+def map_nodes(func, rpc_connections):
+    """Call func on every RPC connection concurrently, one thread per node"""
+    global node_executor, node_executor_workers
+    if len(rpc_connections) <= 1:
+        return [func(r) for r in rpc_connections]
+    if len(rpc_connections) > node_executor_workers:
+        if node_executor is not None:
+            node_executor.shutdown()
+        node_executor_workers = max(len(rpc_connections), MAX_NODES)
+        node_executor = ThreadPoolExecutor(max_workers=node_executor_workers)
+    return list(node_executor.map(func, rpc_connections))
+
+@track_sync_time
 def sync_blocks(rpc_connections, *, wait=1, timeout=60):
     """
     Wait until everybody has the same tip.
@@ -130,15 +212,20 @@ def sync_blocks(rpc_connections, *, wait=1, timeout=60):
     sync_blocks needs to be called with an rpc_connections set that has least
     one node already synced to the latest, stable tip, otherwise there's a
     chance it might return before all nodes are stably synced.
+
+    All nodes are long-polled with waitforblockheight concurrently, so this
+    returns as soon as the slowest node reaches the tip.
     """
     # Use getblockcount() instead of waitforblockheight() to determine the
     # initial max height because the two RPCs look at different internal global
     # variables (chainActive vs latestBlock) and the former gets updated
     # earlier.
-    maxheight = max(x.getblockcount() for x in rpc_connections)
+    maxheight = max(map_nodes(lambda r: r.getblockcount(), rpc_connections))
     start_time = cur_time = time.time()
     while cur_time <= start_time + timeout:
-        tips = [r.waitforblockheight(maxheight, int(wait * 1000)) for r in rpc_connections]
+        # A waitforblockheight timeout of 0 would wait forever
+        wait_ms = max(1, int(min(wait, start_time + timeout - cur_time) * 1000))
+        tips = map_nodes(lambda r: r.waitforblockheight(maxheight, wait_ms), rpc_connections)
         if all(t["height"] == maxheight for t in tips):
             if all(t["hash"] == tips[0]["hash"] for t in tips):
                 return
@@ -148,37 +235,126 @@ def sync_blocks(rpc_connections, *, wait=1, timeout=60):
     raise AssertionError("Block sync to height {} timed out:{}".format(
                          maxheight, "".join("\n  {!r}".format(tip) for tip in tips)))
 
+@track_sync_time
 def sync_chain(rpc_connections, *, wait=1, timeout=60):
     """
     Wait until everybody has the same best block
+
+    Polls with exponential backoff starting at 10ms, up to wait seconds.
     """
-    while timeout > 0:
-        best_hash = [x.getbestblockhash() for x in rpc_connections]
+    deadline = time.time() + timeout
+    for delay in backoff_delays(wait):
+        best_hash = map_nodes(lambda r: r.getbestblockhash(), rpc_connections)
         if best_hash == [best_hash[0]]*len(best_hash):
             return
-        time.sleep(wait)
-        timeout -= wait
+        if time.time() + delay > deadline:
+            break
+        time.sleep(delay)
     raise AssertionError("Chain sync failed: Best block hashes don't match")
 
+@track_sync_time
 def sync_mempools(rpc_connections, *, wait=1, timeout=60):
     """
     Wait until everybody has the same transactions in their memory
     pools
+
+    Compares the cheap getmempoolinfo size and bytes first and only fetches
+    the full getrawmempool lists once those agree. Polls with exponential
+    backoff starting at 10ms, up to wait seconds.
     """
-    while timeout > 0:
-        pool = set(rpc_connections[0].getrawmempool())
-        num_match = 1
-        for i in range(1, len(rpc_connections)):
-            if set(rpc_connections[i].getrawmempool()) == pool:
-                num_match = num_match+1
-        if num_match == len(rpc_connections):
-            return
-        time.sleep(wait)
-        timeout -= wait
+    deadline = time.time() + timeout
+    for delay in backoff_delays(wait):
+        infos = map_nodes(lambda r: r.getmempoolinfo(), rpc_connections)
+        if all((i["size"], i["bytes"]) == (infos[0]["size"], infos[0]["bytes"]) for i in infos):
+            pools = map_nodes(lambda r: set(r.getrawmempool()), rpc_connections)
+            if all(pool == pools[0] for pool in pools):
+                return
+        if time.time() + delay > deadline:
+            break
+        time.sleep(delay)
     raise AssertionError("Mempool sync failed")
 
 dogecoind_processes = {}
 
+# Pre-started dogecoinds that have not been adopted yet: datadir -> pid
+warm_nodes = {}
+warm_mocktime = None
+warm_cachedir = None
+
+class WarmProcess:
+    """
+    Stand-in for the subprocess.Popen of a dogecoind started by the test
+    runner, which is not our child.  When the node exits, the runner writes
+    its exit status to WARM_EXIT_FILE before reaping it, so until the file
+    appears the pid is still the node's (running, or a zombie) and can be
+    signalled, and once it appears the node is gone.
+    """
+
+    def __init__(self, pid, datadir):
+        self.pid = pid
+        self.status_file = os.path.join(datadir, WARM_EXIT_FILE)
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                with open(self.status_file, encoding='utf8') as f:
+                    self.returncode = int(f.read())
+            except (OSError, ValueError):
+                # Still running, or the runner is writing the status
+                return None
+        return self.returncode
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while self.poll() is None:
+            if deadline is not None and time.time() > deadline:
+                raise subprocess.TimeoutExpired("dogecoind (pid %d)" % self.pid, timeout)
+            time.sleep(0.05)
+        return self.returncode
+
+    def terminate(self):
+        if self.poll() is None:
+            os.kill(self.pid, signal.SIGTERM)
+
+    def kill(self):
+        if self.poll() is None:
+            os.kill(self.pid, signal.SIGKILL)
+
+def load_warm_nodes(dirname):
+    """
+    Pick up the dogecoinds the test runner started in dirname, if any.
+    spawn_dogecoind adopts them instead of starting new ones.
+    """
+    global warm_mocktime, warm_cachedir
+    path = os.path.join(dirname, WARM_NODES_FILE)
+    if fcntl is None or not os.path.exists(path):
+        return
+    with open(path, encoding='utf8') as f:
+        info = json.load(f)
+    warm_nodes.update(info["nodes"])
+    warm_mocktime = info["mocktime"]
+    warm_cachedir = info["cachedir"]
+    os.remove(path)
+
+def discard_warm_node(datadir, restore=True):
+    """
+    Stop the unadopted warm dogecoind in datadir and, if restore is set,
+    replace its datadir with a fresh copy from the cache.
+    """
+    process = WarmProcess(warm_nodes.pop(datadir), datadir)
+    process.terminate()
+    process.wait(timeout=DOGECOIND_PROC_WAIT_TIMEOUT)
+    if restore:
+        shutil.rmtree(datadir)
+        snapshot_datadir(os.path.join(warm_cachedir, os.path.basename(datadir)), datadir)
+        initialize_datadir(os.path.dirname(datadir), int(os.path.basename(datadir)[len("node"):]))
+
+def release_warm_nodes():
+    """Stop all warm dogecoinds the test did not use"""
+    for datadir in list(warm_nodes):
+        discard_warm_node(datadir, restore=False)
+
 def initialize_datadir(dirname, n):
     datadir = os.path.join(dirname, "node"+str(n))
     if not os.path.isdir(datadir):
@@ -249,25 +425,20 @@ def initialize_chain(test_dir, num_nodes, cachedir):
                 shutil.rmtree(os.path.join(cachedir,"node"+str(i)))
 
         # Create cache directories, run dogecoinds:
+        start_time = time.time()
         for i in range(MAX_NODES):
             datadir=initialize_datadir(cachedir, i)
             args = [ os.getenv("DOGECOIND", "dogecoind"), "-server", "-keypool=1", "-datadir="+datadir, "-discover=0" ]
             if i > 0:
                 args.append("-connect=127.0.0.1:"+str(p2p_port(0)))
             dogecoind_processes[i] = subprocess.Popen(args)
-            if os.getenv("PYTHON_DEBUG", ""):
-                print("initialize_chain: dogecoind started, waiting for RPC to come up")
-            wait_for_dogecoind_start(dogecoind_processes[i], rpc_url(i), i)
-            if os.getenv("PYTHON_DEBUG", ""):
-                print("initialize_chain: RPC successfully started")
-
-        rpcs = []
-        for i in range(MAX_NODES):
-            try:
-                rpcs.append(get_rpc_proxy(rpc_url(i), i))
-            except:
-                sys.stderr.write("Error connecting to "+url+"\n")
-                sys.exit(1)
+        if os.getenv("PYTHON_DEBUG", ""):
+            print("initialize_chain: dogecoinds started, waiting for RPC to come up")
+        rpcs, startup_times = wait_for_dogecoinds_start([rpc_url(i) for i in range(MAX_NODES)], start_time)
+        if os.getenv("PYTHON_DEBUG", ""):
+            print("initialize_chain: RPC successfully started")
+        if os.getenv("PYTHON_DEBUG", ""):
+            print_startup_times("initialize_chain", startup_times)
 
         # Create a 120-block-long chain; each of the 4 first nodes
         # gets 15 mature blocks and 15 immature.
@@ -296,11 +467,64 @@ def initialize_chain(test_dir, num_nodes, cachedir):
             os.remove(log_filename(cachedir, i, "peers.dat"))
             os.remove(log_filename(cachedir, i, "fee_estimates.dat"))
 
+    start_time = time.time()
+    methods = Counter()
     for i in range(num_nodes):
         from_dir = os.path.join(cachedir, "node"+str(i))
         to_dir = os.path.join(test_dir,  "node"+str(i))
-        shutil.copytree(from_dir, to_dir)
+        if to_dir in warm_nodes:
+            continue # Already materialized and started by the test runner
+        methods.update(snapshot_datadir(from_dir, to_dir))
         initialize_datadir(test_dir, i) # Overwrite port/rpcport in dogecoin.conf
+    if os.getenv("PYTHON_DEBUG", ""):
+        print("initialize_chain: materialized %d node(s) from cache in %.2fs (%s)" % (num_nodes, time.time() - start_time,
+              ", ".join("%s: %d" % m for m in sorted(methods.items()))))
+
+_reflink_supported = fcntl is not None
+
+def snapshot_file(src, dst):
+    '''
+    Copy a single datadir file. Reflink it if the filesystem supports
+    copy-on-write clones, otherwise hardlink it if it is immutable, and
+    copy it as a last resort. Returns the method used.
+    '''
+    global _reflink_supported
+    if _reflink_supported:
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return "reflink"
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS):
+                _reflink_supported = False
+            if os.path.exists(dst):
+                os.remove(dst)
+    if src.endswith(IMMUTABLE_DATADIR_FILES):
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return "copy"
+
+def snapshot_datadir(from_dir, to_dir):
+    '''
+    Materialize the cached datadir from_dir at to_dir without copying more
+    than necessary (see snapshot_file), falling back to a plain copytree.
+    Returns a Counter of the methods used per file.
+    '''
+    methods = Counter()
+    def copy_function(src, dst):
+        methods[snapshot_file(src, dst)] += 1
+    try:
+        shutil.copytree(from_dir, to_dir, copy_function=copy_function)
+    except (OSError, shutil.Error):
+        shutil.rmtree(to_dir, ignore_errors=True)
+        shutil.copytree(from_dir, to_dir)
+        methods = Counter(copytree=1)
+    return methods
 
 def initialize_chain_clean(test_dir, num_nodes):
     """
@@ -308,6 +532,10 @@ def initialize_chain_clean(test_dir, num_nodes):
     Useful if a test case wants complete control over initialization.
     """
     for i in range(num_nodes):
+        datadir = os.path.join(test_dir, "node"+str(i))
+        if datadir in warm_nodes:
+            discard_warm_node(datadir, restore=False)
+            shutil.rmtree(datadir)
         datadir=initialize_datadir(test_dir, i)
 
 
@@ -331,42 +559,120 @@ def _rpchost_to_args(rpchost):
         rv += ['-rpcport=' + rpcport]
     return rv
 
-def start_node(i, dirname, extra_args=None, rpchost=None, timewait=None, binary=None):
+def dogecoind_args(i, dirname, extra_args=None, binary=None):
     """
-    Start a dogecoind and return RPC connection to it
+    Return the command line for node i's dogecoind
     """
     datadir = os.path.join(dirname, "node"+str(i))
     if binary is None:
         binary = os.getenv("DOGECOIND", "dogecoind")
     args = [ binary, "-datadir="+datadir, "-server", "-keypool=1", "-discover=0", "-rest", "-mocktime="+str(get_mocktime()) ]
     if extra_args is not None: args.extend(extra_args)
-    dogecoind_processes[i] = subprocess.Popen(args)
+    return args
+
+def spawn_dogecoind(i, dirname, extra_args=None, binary=None):
+    """
+    Launch dogecoind for node i without waiting for its RPC to come up
+
+    A warm dogecoind started by the test runner in the same datadir with
+    the default arguments is adopted instead; one started differently is
+    replaced.
+    """
+    datadir = os.path.join(dirname, "node"+str(i))
+    if datadir in warm_nodes:
+        if not extra_args and binary is None and warm_mocktime == get_mocktime():
+            dogecoind_processes[i] = WarmProcess(warm_nodes.pop(datadir), datadir)
+            return
+        discard_warm_node(datadir)
+    dogecoind_processes[i] = subprocess.Popen(dogecoind_args(i, dirname, extra_args, binary))
+
+def connect_dogecoind(i, url, timewait=None):
+    """
+    Return an RPC connection to the (started) dogecoind for node i
+    """
+    proxy = get_rpc_proxy(url, i, timeout=timewait)
+
+    if COVERAGE_DIR:
+        coverage.write_all_rpc_commands(COVERAGE_DIR, proxy)
+
+    return proxy
+
+def start_node(i, dirname, extra_args=None, rpchost=None, timewait=None, binary=None):
+    """
+    Start a dogecoind and return RPC connection to it
+    """
+    spawn_dogecoind(i, dirname, extra_args, binary)
     if os.getenv("PYTHON_DEBUG", ""):
         print("start_node: dogecoind started, waiting for RPC to come up")
     url = rpc_url(i, rpchost)
     wait_for_dogecoind_start(dogecoind_processes[i], url, i)
     if os.getenv("PYTHON_DEBUG", ""):
         print("start_node: RPC successfully started")
-    proxy = get_rpc_proxy(url, i, timeout=timewait)
-
-    if COVERAGE_DIR:
-        coverage.write_all_rpc_commands(COVERAGE_DIR, proxy)
+    return connect_dogecoind(i, url, timewait)
 
-    return proxy
+def wait_for_dogecoinds_start(urls, start_time, timewait=None):
+    """
+    Wait concurrently for the already spawned dogecoinds 0..len(urls)-1 to
+    start. Returns their RPC connections and the seconds each took since
+    start_time. If any of them fails, the ones that did start are stopped,
+    the others are killed, and the first error is raised.
+    """
+    def wait_for_node(i):
+        wait_for_dogecoind_start(dogecoind_processes[i], urls[i], i)
+        return connect_dogecoind(i, urls[i], timewait), time.time() - start_time
+
+    with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+        futures = [executor.submit(wait_for_node, i) for i in range(len(urls))]
+    rpcs = [None] * len(urls)
+    startup_times = [None] * len(urls)
+    error = None
+    for i, future in enumerate(futures):
+        try:
+            rpcs[i], startup_times[i] = future.result()
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        stop_started_nodes(rpcs)
+        raise error
+    return rpcs, startup_times
+
+def stop_started_nodes(rpcs):
+    """
+    Clean up after a failed start: stop node i if rpcs[i] is connected,
+    otherwise kill its dogecoind if one was spawned.
+    """
+    for i, rpc in enumerate(rpcs):
+        if rpc is not None:
+            stop_node(rpc, i)
+        elif i in dogecoind_processes:
+            process = dogecoind_processes.pop(i)
+            if process.poll() is None:
+                process.kill()
+            process.wait(timeout=DOGECOIND_PROC_WAIT_TIMEOUT)
+
+def print_startup_times(caller, startup_times):
+    print("%s: %d node(s) up in %.2fs (%s)" % (caller, len(startup_times), max(startup_times, default=0),
+          ", ".join("node%d %.2fs" % (i, t) for i, t in enumerate(startup_times))))
 
 def start_nodes(num_nodes, dirname, extra_args=None, rpchost=None, timewait=None, binary=None):
     """
     Start multiple dogecoinds, return RPC connections to them
+
+    All dogecoinds are spawned first and their RPC interfaces are then
+    awaited in parallel.
     """
     if extra_args is None: extra_args = [ None for _ in range(num_nodes) ]
     if binary is None: binary = [ None for _ in range(num_nodes) ]
-    rpcs = []
+    start_time = time.time()
     try:
         for i in range(num_nodes):
-            rpcs.append(start_node(i, dirname, extra_args[i], rpchost, timewait=timewait, binary=binary[i]))
+            spawn_dogecoind(i, dirname, extra_args[i], binary[i])
     except: # If one node failed to start, stop the others
-        stop_nodes(rpcs)
+        stop_started_nodes([None] * num_nodes)
         raise
+    rpcs, startup_times = wait_for_dogecoinds_start([rpc_url(i, rpchost) for i in range(num_nodes)], start_time, timewait)
+    if os.getenv("PYTHON_DEBUG", ""):
+        print_startup_times("start_nodes", startup_times)
     return rpcs
 
 def log_filename(dirname, n_node, logname):
@@ -386,9 +692,43 @@ def stop_nodes(nodes):
         stop_node(node, i)
     assert not dogecoind_processes.values() # All connections must be gone now
 
-def set_node_times(nodes, t):
+# The event loop call_nodes_async runs on, and its AsyncAuthServiceProxy
+# per RPC URL, kept so that their keep-alive connections are reused
+async_loop = None
+async_proxies = {}
+
+def call_nodes_async(nodes, method, *args):
+    """
+    Call the RPC method with args on all nodes concurrently through
+    AsyncAuthServiceProxy, and return the results in node order.  Nodes
+    must have been created by get_rpc_proxy (so that node.url is set).
+    """
+    global async_loop
+    if async_loop is None:
+        async_loop = asyncio.new_event_loop()
+    proxies = []
     for node in nodes:
-        node.setmocktime(t)
+        if node.url not in async_proxies:
+            on_transfer = None
+            if isinstance(node, coverage.AuthServiceProxyWrapper) and node.stats_node is not None:
+                on_transfer = functools.partial(rpcstats.record_transfer, node.stats_node)
+            async_proxies[node.url] = AsyncAuthServiceProxy(node.url, on_transfer=on_transfer)
+        proxies.append(async_proxies[node.url])
+
+    async def call(proxy):
+        start_time = time.time()
+        result = await getattr(proxy, method)(*args)
+        return result, time.time() - start_time
+    async def call_all():
+        return await asyncio.gather(*(call(proxy) for proxy in proxies))
+    results = async_loop.run_until_complete(call_all())
+    for (node, (result, seconds)) in zip(nodes, results):
+        if isinstance(node, coverage.AuthServiceProxyWrapper):
+            node.record_calls([method], seconds)
+    return [result for (result, seconds) in results]
+
+def set_node_times(nodes, t):
+    call_nodes_async(nodes, "setmocktime", t)
 
 def connect_nodes(from_connection, node_num):
     ip_port = "127.0.0.1:"+str(p2p_port(node_num))
@@ -631,17 +971,25 @@ def create_confirmed_utxos(fee, node, count):
     addr2 = node.getnewaddress()
     if iterations <= 0:
         return utxos
-    for i in range(iterations):
-        t = utxos.pop()
-        inputs = []
-        inputs.append({ "txid" : t["txid"], "vout" : t["vout"]})
-        outputs = {}
-        send_value = t['amount'] - fee
-        outputs[addr1] = satoshi_round(send_value/2)
-        outputs[addr2] = satoshi_round(send_value/2)
-        raw_tx = node.createrawtransaction(inputs, outputs)
-        signed_tx = node.signrawtransaction(raw_tx)["hex"]
-        txid = node.sendrawtransaction(signed_tx)
+    # The spends are independent, so create, sign and send them in three
+    # batched round-trips instead of three per utxo
+    with node.batch() as b:
+        raw_txs = []
+        for i in range(iterations):
+            t = utxos.pop()
+            inputs = []
+            inputs.append({ "txid" : t["txid"], "vout" : t["vout"]})
+            outputs = {}
+            send_value = t['amount'] - fee
+            outputs[addr1] = satoshi_round(send_value/2)
+            outputs[addr2] = satoshi_round(send_value/2)
+            raw_txs.append(b.createrawtransaction(inputs, outputs))
+    with node.batch() as b:
+        signed_txs = [b.signrawtransaction(raw_tx.result()) for raw_tx in raw_txs]
+    with node.batch() as b:
+        txids = [b.sendrawtransaction(signed_tx.result()["hex"]) for signed_tx in signed_txs]
+    for txid in txids:
+        txid.result()
 
     while (node.getmempoolinfo()['size'] > 0):
         node.generate(1)
@@ -653,22 +1001,26 @@ def create_confirmed_utxos(fee, node, count):
 # Create large OP_RETURN txouts that can be appended to a transaction
 # to make it large (helper for constructing large transactions).
 def gen_return_txouts():
-    # Some pre-processing to create a bunch of OP_RETURN txouts to insert into transactions we create
-    # So we have big transactions (and therefore can't fit very many into each block)
-    # create one script_pubkey
-    script_pubkey = "6a4d0200" #OP_RETURN OP_PUSH2 512 bytes
-    for i in range (512):
-        script_pubkey = script_pubkey + "01"
+    """
+    Return the hex of 128 large OP_RETURN txouts, preceded by the output
+    count (129, with the change output), for splicing into a raw
+    transaction in place of its output count.  Kept for callers that
+    splice hex; create_lots_of_big_transactions() also takes the
+    CTxOuts from gen_return_ctxouts().
+    """
+    script_pubkey = "6a4d0200" + "01" * 512 #OP_RETURN OP_PUSH2 512 bytes
     # concatenate 128 txouts of above script_pubkey which we'll insert before the txout for change
-    txouts = "81"
-    for k in range(128):
-        # add txout value
-        txouts = txouts + "0000000000000000"
-        # add length of script_pubkey
-        txouts = txouts + "fd0402"
-        # add script_pubkey
-        txouts = txouts + script_pubkey
-    return txouts
+    return "81" + ("0000000000000000" + "fd0402" + script_pubkey) * 128
+
+def gen_return_ctxouts():
+    """
+    Return a list of 128 new CTxOuts, each a zero-value OP_RETURN pushing
+    512 bytes, to add to transactions we create so we have big
+    transactions (about 66kB, and therefore can't fit very many into each
+    block).  See create_lots_of_big_transactions().
+    """
+    from .mininode import filler_txouts
+    return filler_txouts(128)
 
 def create_tx(node, coinbase, to_address, amount):
     inputs = [{ "txid" : coinbase, "vout" : 0}]
@@ -678,37 +1030,47 @@ def create_tx(node, coinbase, to_address, amount):
     assert_equal(signresult["complete"], True)
     return signresult["hex"]
 
-# Create a spend of each passed-in utxo, splicing in "txouts" to each raw
-# transaction to make it large.  See gen_return_txouts() above.
-def create_lots_of_big_transactions(node, txouts, utxos, num, fee):
+# Create a spend of each passed-in utxo with the CTxOuts "txouts" (see
+# gen_return_ctxouts() above) before the change output to make it large, or
+# padded to size bytes before signing.  txouts may also be the hex from
+# gen_return_txouts().
+def create_lots_of_big_transactions(node, txouts, utxos, num, fee, size=None):
+    from .mininode import COIN, COutPoint, CTransaction, CTxIn, CTxOut, ToHex, deser_compact_size, pad_tx
+    if isinstance(txouts, str):
+        f = BytesIO(hex_str_to_bytes(txouts))
+        deser_compact_size(f) # The output count, including the change output
+        txouts = []
+        while f.tell() < len(f.getbuffer()):
+            txouts.append(CTxOut())
+            txouts[-1].deserialize(f)
     addr = node.getnewaddress()
-    txids = []
+    change_script = hex_str_to_bytes(node.validateaddress(addr)["scriptPubKey"])
+    rawtxs = []
     for _ in range(num):
         t = utxos.pop()
-        inputs=[{ "txid" : t["txid"], "vout" : t["vout"]}]
-        outputs = {}
-        change = t['amount'] - fee
-        outputs[addr] = satoshi_round(change)
-        rawtx = node.createrawtransaction(inputs, outputs)
-        newtx = rawtx[0:92]
-        newtx = newtx + txouts
-        newtx = newtx + rawtx[94:]
-        signresult = node.signrawtransaction(newtx, None, None, "NONE")
-        txid = node.sendrawtransaction(signresult["hex"], True)
-        txids.append(txid)
-    return txids
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(int(t["txid"], 16), t["vout"]), nSequence=0xffffffff)]
+        change = satoshi_round(t['amount'] - fee)
+        tx.vout = list(txouts) + [CTxOut(int(change * COIN), change_script)]
+        if size is not None:
+            pad_tx(tx, size)
+        rawtxs.append(ToHex(tx))
+    with node.batch() as b:
+        signresults = [b.signrawtransaction(rawtx, None, None, "NONE") for rawtx in rawtxs]
+    with node.batch() as b:
+        txids = [b.sendrawtransaction(signresult.result()["hex"], True) for signresult in signresults]
+    return [txid.result() for txid in txids]
 
 def mine_large_block(node, utxos=None):
     # generate a 66k transaction,
     # and 14 of them is close to the 1MB block limit
     num = 14
-    txouts = gen_return_txouts()
     utxos = utxos if utxos is not None else []
     if len(utxos) < num:
         utxos.clear()
         utxos.extend(node.listunspent())
     fee = 100 * node.getnetworkinfo()["relayfee"]
-    create_lots_of_big_transactions(node, txouts, utxos, num, fee=fee)
+    create_lots_of_big_transactions(node, [], utxos, num, fee=fee, size=66000)
     node.generate(1)
 
 def get_bip9_status(node, key):